@@ -0,0 +1,126 @@
+"""Archival of the completed records from the notebooks accounting db
+
+Completed records ending before the retention horizon (together with their
+hourly usage series) are moved into a separate archive database with the
+same schema. The previous values of the archived records (VMChange) are only
+deleted, they are not needed after the retention. The main database is
+vacuumed afterwards, so the queries over the recent data stay fast and the
+database file does not grow forever.
+
+Usage reports can still read the archive (see report.py --archive).
+
+Configuration:
+[default]
+notebooks_db=<notebooks db file>
+archive_db=<archive db file>
+# retention of the completed records in the main db (in days)
+archive_retention=365
+"""
+
+import argparse
+import logging
+import os
+import sys
+from configparser import ConfigParser
+from datetime import datetime, timedelta, timezone
+
+from .model import VM, VMChange, VMSeries, archive_db_init, db_init
+
+CONFIG = "default"
+DEFAULT_CONFIG_FILE = "config.ini"
+DEFAULT_RETENTION = 365
+
+
+def copy_rows(db, model, condition):
+    """Copy rows of the model into the attached archive."""
+    columns = ", ".join(f'"{field.column_name}"' for field in model._meta.sorted_fields)
+    select_sql, params = model.select(*model._meta.sorted_fields).where(condition).sql()
+    db.execute_sql(
+        f'INSERT OR REPLACE INTO archive."{model._meta.table_name}" ({columns}) {select_sql}',
+        params,
+    )
+
+
+def archive(db, archive_file, horizon, dry_run=False):
+    """Move completed records ending before the horizon into the archive.
+
+    Returns number of the archived records.
+    """
+    # only completed records have the end time
+    condition = VM.end_time < horizon
+    count = VM.select().where(condition).count()
+    logging.info(f"{count} completed records ending before {horizon}")
+    if dry_run or not count:
+        return count
+
+    archive_db_init(archive_file)
+    series_condition = VMSeries.local_id.in_(VM.select(VM.local_id).where(condition))
+    db.execute_sql("ATTACH DATABASE ? AS archive", (archive_file,))
+    try:
+        with db.atomic():
+            copy_rows(db, VM, condition)
+            copy_rows(db, VMSeries, series_condition)
+            VMSeries.delete().where(series_condition).execute()
+            VMChange.delete().where(
+                VMChange.local_id.in_(VM.select(VM.local_id).where(condition))
+            ).execute()
+            VM.delete().where(condition).execute()
+    finally:
+        db.execute_sql("DETACH DATABASE archive")
+    logging.debug("Vacuum database")
+    db.execute_sql("VACUUM")
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Notebooks accounting records archival"
+    )
+    parser.add_argument(
+        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+    )
+    parser.add_argument("--archive-db", help="archive db file")
+    parser.add_argument(
+        "--retention",
+        help=f"retention of the completed records in days (default: {DEFAULT_RETENTION})",
+        type=int,
+    )
+    parser.add_argument(
+        "--dry-run", help="Do not move the records, just report", action="store_true"
+    )
+    args = parser.parse_args(argv)
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    config = parser[CONFIG] if CONFIG in parser else {}
+
+    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
+    verbose = logging.DEBUG if verbose == "1" else logging.INFO
+    logging.basicConfig(level=verbose)
+
+    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+    archive_file = args.archive_db or os.environ.get(
+        "ARCHIVE_DB", config.get("archive_db", None)
+    )
+    retention = args.retention
+    if retention is None:
+        retention = int(
+            os.environ.get(
+                "ARCHIVE_RETENTION", config.get("archive_retention", DEFAULT_RETENTION)
+            )
+        )
+    if not db_file or not archive_file:
+        logging.error("Both notebooks_db and archive_db need to be configured")
+        return 1
+
+    db = db_init(db_file)
+    horizon = datetime.now(timezone.utc) - timedelta(days=retention)
+    with db.connection_context():
+        count = archive(db, archive_file, horizon, args.dry_run)
+    if not args.dry_run:
+        logging.info(f"Archived {count} records into '{archive_file}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
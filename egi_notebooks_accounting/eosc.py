@@ -27,6 +27,12 @@ with a JSON like:
 This code goes to the accounting db and aggregates the information for the last 24 hours
 and pushes it to the EOSC Accounting
 
+With --changed the days already reported are re-reported first, but only the
+(day, user, group, metric) values affected by the pods modified since the
+previous re-report (see the modification marker in pods.set_modified). The
+days from the start of the modified pod until its modification are affected
+(the previous end time is not known, but not later than the modification).
+
 Configuration:
 [default]
 notebooks_db=<notebooks db file>
@@ -39,6 +45,7 @@ accounting_url=https://api.acc.staging.eosc.grnet.gr
 installation_id=<id of the installation to report accounting for>
 timeout=120
 timestamp_file=<file where the timestamp of the last run is kept>
+changes_timestamp_file=<file where the time of the last re-report is kept>
 
 [eosc.flavors]
 # contains a list of flavors and metrics they are mapped to
@@ -50,6 +57,7 @@ small-environment-2-vcpu-4-gb-ram=668bdd5988e1d617b217ecb9
 import argparse
 import json
 import logging
+import math
 import os
 from configparser import ConfigParser
 from datetime import datetime, timedelta, timezone
@@ -58,7 +66,7 @@ import dateutil.parser
 import requests
 from requests.auth import HTTPBasicAuth
 
-from .model import VM, db_init
+from .model import VM, VMChange, db_init
 
 CONFIG = "default"
 EOSC_CONFIG = "eosc"
@@ -67,6 +75,9 @@ DEFAULT_CONFIG_FILE = "config.ini"
 DEFAULT_TOKEN_URL = "https://proxy.staging.eosc-federation.eu/OIDC/token"
 DEFAULT_ACCOUNTING_URL = "https://api.acc.staging.eosc.grnet.gr"
 DEFAULT_TIMESTAMP_FILE = "eosc-accounting.timestamp"
+DEFAULT_CHANGES_TIMESTAMP_FILE = "eosc-accounting-changes.timestamp"
+DAY = timedelta(days=1)
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 
 def get_access_token(token_url, client_id, client_secret, timeout=None):
@@ -95,6 +106,25 @@ def push_metric(accounting_url, token, installation, metric_data, timeout=None):
     response.raise_for_status()
 
 
+def get_pod_interval(pod, period_start, period_end):
+    """Running interval of the pod clamped to the reporting period.
+
+    Works with both timezone-aware datetimes and epoch timestamps, returns
+    tuple of (start, end).
+    """
+    if pod.start_time is None:
+        start_time = period_start
+    else:
+        start_time = max(period_start, pod.start_time)
+
+    if pod.end_time is None:
+        end_time = period_end
+    else:
+        end_time = min(period_end, pod.end_time)
+
+    return start_time, end_time
+
+
 def update_pod_metric(pod, metrics, flavor_config, period_start, period_end):
     if not pod.flavor or pod.flavor not in flavor_config:
         # cannot report
@@ -105,39 +135,44 @@ def update_pod_metric(pod, metrics, flavor_config, period_start, period_end):
     flavor_metric = flavor_config[pod.flavor]
     metrics[(user, group)] = user_metrics
 
-    if pod.start_time is None:
-        report_start_time = period_start
-    else:
-        report_start_time = max(
-            period_start, pod.start_time.replace(tzinfo=timezone.utc)
-        )
-
-    if pod.end_time is None:
-        report_end_time = period_end
-    else:
-        report_end_time = min(period_end, pod.end_time.replace(tzinfo=timezone.utc))
-
+    report_start_time, report_end_time = get_pod_interval(pod, period_start, period_end)
     flavor_metric_value = user_metrics.get(flavor_metric, 0)
     user_metrics[flavor_metric] = (
         flavor_metric_value + (report_end_time - report_start_time).total_seconds()
     )
 
 
+def read_timestamp(timestamp_file):
+    """Read the time from the timestamp file, None if not available."""
+    try:
+        with open(timestamp_file, "r") as tsf:
+            try:
+                return dateutil.parser.parse(tsf.read())
+            except dateutil.parser.ParserError as e:
+                logging.debug(f"Invalid timestamp content in '{timestamp_file}': {e}")
+    except OSError as e:
+        logging.debug(f"Not able to open timestamp file '{timestamp_file}': {e}")
+    return None
+
+
+def write_timestamp(timestamp_file, timestamp):
+    try:
+        with open(timestamp_file, "w+") as tsf:
+            timestamp_str = timestamp.strftime(TIMESTAMP_FORMAT)
+            logging.debug(
+                f"Writing following timestamp to '{timestamp_file}': {timestamp_str}"
+            )
+            tsf.write(timestamp_str)
+    except OSError as e:
+        logging.debug(f"Failed to write timestamp file '{timestamp_file}': {e}")
+
+
 def get_from_to_dates(args, timestamp_file):
     from_date = None
     if args.from_date:
         from_date = dateutil.parser.parse(args.from_date)
     else:
-        try:
-            with open(timestamp_file, "r") as tsf:
-                try:
-                    from_date = dateutil.parser.parse(tsf.read())
-                except dateutil.parser.ParserError as e:
-                    logging.debug(
-                        f"Invalid timestamp content in '{timestamp_file}': {e}"
-                    )
-        except OSError as e:
-            logging.debug(f"Not able to open timestamp file '{timestamp_file}': {e}")
+        from_date = read_timestamp(timestamp_file)
         # no date specified report from yesterday
         if not from_date:
             from_date = (datetime.now(timezone.utc) - timedelta(days=1)).replace(
@@ -153,24 +188,18 @@ def get_from_to_dates(args, timestamp_file):
     return from_date, to_date
 
 
-def generate_day_metrics(
-    period_start,
-    period_end,
-    accounting_url,
-    token,
-    flavor_config,
-    timestamp_file,
-    installation,
-    dry_run,
-    timeout=None,
-):
-    logging.info(f"Generate metrics from {period_start} to {period_end}")
+def get_day_metrics(period_start, period_end, flavor_config, users=None):
+    """Aggregate the running time of the pods per (user, group) and metric.
+
+    :param users: only the pods of the users (all pods by default)
+    """
     metrics = {}
+    query = VM.select()
+    if users is not None:
+        query = query.where(VM.global_user_name.in_(users))
     # pods ending in between the reporting times
     count = 0
-    for pod in VM.select().where(
-        (VM.end_time >= period_start) & (VM.end_time < period_end)
-    ):
+    for pod in query.where((VM.end_time >= period_start) & (VM.end_time < period_end)):
         update_pod_metric(
             pod,
             metrics,
@@ -181,25 +210,38 @@ def generate_day_metrics(
         count = count + 1
     logging.debug(f"=> {count} pods ending in between the reporting times")
 
-    # pods starting but not finished between the reporting times
+    # pods starting but not finished between the reporting times, the running
+    # pods are searched separately by the end_time index (end_time IS NULL),
+    # the joined condition would scan the start_time index over the history
     count = 0
-    for pod in VM.select().where(
-        (VM.start_time < period_end)
-        & (VM.end_time.is_null() | (VM.end_time >= period_end))
-    ):
-        update_pod_metric(
-            pod,
-            metrics,
-            flavor_config,
-            period_start,
-            period_end,
-        )
-        count = count + 1
+    for condition in (VM.end_time.is_null(), VM.end_time >= period_end):
+        for pod in query.where((VM.start_time < period_end) & condition):
+            update_pod_metric(
+                pod,
+                metrics,
+                flavor_config,
+                period_start,
+                period_end,
+            )
+            count = count + 1
     logging.debug(
         f"=> {count} pods starting but not finished between the reporting times"
     )
-    period_start_str = period_start.strftime("%Y-%m-%dT%H:%M:%SZ")
-    period_end_str = period_end.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return metrics
+
+
+def send_metrics(
+    metrics,
+    period_start,
+    period_end,
+    accounting_url,
+    token,
+    installation,
+    dry_run,
+    timeout=None,
+):
+    period_start_str = period_start.strftime(TIMESTAMP_FORMAT)
+    period_end_str = period_end.strftime(TIMESTAMP_FORMAT)
     for (user, group), flavors in metrics.items():
         for metric_key, value in flavors.items():
             metric_data = {
@@ -216,18 +258,109 @@ def generate_day_metrics(
                 logging.debug("Dry run, not sending")
             else:
                 push_metric(accounting_url, token, installation, metric_data, timeout)
+
+
+def generate_day_metrics(
+    period_start,
+    period_end,
+    accounting_url,
+    token,
+    flavor_config,
+    timestamp_file,
+    installation,
+    dry_run,
+    timeout=None,
+):
+    logging.info(f"Generate metrics from {period_start} to {period_end}")
+    metrics = get_day_metrics(period_start, period_end, flavor_config)
+    send_metrics(
+        metrics,
+        period_start,
+        period_end,
+        accounting_url,
+        token,
+        installation,
+        dry_run,
+        timeout,
+    )
     if not dry_run:
-        try:
-            with open(timestamp_file, "w+") as tsf:
-                timestamp_str = period_end.strftime("%Y-%m-%dT%H:%M:%SZ")
-                logging.debug(
-                    f"Writing following timestamp to '{timestamp_file}': {timestamp_str}"
-                )
-                # we have open interval at the end => store the time just before the ending
-                tsf.write(timestamp_str)
-        except OSError as e:
-            e = str(e)
-            logging.debug("Failed to write timestamp file '{timestamp_file}': {e}")
+        write_timestamp(timestamp_file, period_end)
+
+
+def get_changed_cells(since, until, reported_until, flavor_config):
+    """Reported values affected by the pods modified in between the times.
+
+    The days are aligned to the end of the reported days.
+
+    Returns dictionary {day start: set of (user, group, metric)}.
+    """
+    cells = {}
+    # the current values and the previous values of the modified pods
+    for model in (VM, VMChange):
+        condition = model.modified < until
+        if since is not None:
+            condition &= model.modified >= since
+        query = model.select().where(condition & (model.start_time < reported_until))
+        for pod in query:
+            if not pod.flavor or pod.flavor not in flavor_config:
+                continue
+            cell = (pod.global_user_name, pod.fqan, flavor_config[pod.flavor])
+            end = pod.modified
+            if model is VMChange and pod.end_time is not None:
+                end = min(pod.end_time, end)
+            day = (
+                reported_until
+                - math.ceil((reported_until - pod.start_time) / DAY) * DAY
+            )
+            while day < min(end, reported_until):
+                cells.setdefault(day, set()).add(cell)
+                day += DAY
+    return cells
+
+
+def report_changes(
+    since,
+    until,
+    reported_until,
+    accounting_url,
+    token,
+    flavor_config,
+    installation,
+    dry_run,
+    timeout=None,
+):
+    """Re-report the values affected by the pods modified in between the times.
+
+    Only the reported days (before reported_until) are recomputed, the values
+    are pushed even if there are no pods anymore (zero).
+    """
+    cells = get_changed_cells(since, until, reported_until, flavor_config)
+    for period_start, day_cells in sorted(cells.items()):
+        period_end = period_start + DAY
+        logging.info(
+            f"Re-report {len(day_cells)} metrics from {period_start} to {period_end}"
+        )
+        users = {user for user, _, _ in day_cells}
+        metrics = get_day_metrics(
+            period_start,
+            period_end,
+            flavor_config,
+            None if None in users else users,
+        )
+        changed = {}
+        for user, group, metric in day_cells:
+            value = metrics.get((user, group), {}).get(metric, 0)
+            changed.setdefault((user, group), {})[metric] = value
+        send_metrics(
+            changed,
+            period_start,
+            period_end,
+            accounting_url,
+            token,
+            installation,
+            dry_run,
+            timeout,
+        )
 
 
 def main(argv=None):
@@ -240,6 +373,11 @@ def main(argv=None):
     )
     parser.add_argument("--from-date", help="Start date to report from")
     parser.add_argument("--to-date", help="End date to report to")
+    parser.add_argument(
+        "--changed",
+        help="Re-report first the reported days affected by the modified pods",
+        action="store_true",
+    )
     args = parser.parse_args(argv)
 
     parser = ConfigParser()
@@ -278,6 +416,34 @@ def main(argv=None):
     timestamp_file = os.environ.get(
         "TIMESTAMP_FILE", eosc_config.get("timestamp_file", DEFAULT_TIMESTAMP_FILE)
     )
+    changes_timestamp_file = os.environ.get(
+        "CHANGES_TIMESTAMP_FILE",
+        eosc_config.get("changes_timestamp_file", DEFAULT_CHANGES_TIMESTAMP_FILE),
+    )
+
+    # ==== changes ====
+    if args.changed:
+        reported_until = read_timestamp(timestamp_file)
+        until = datetime.now(timezone.utc).replace(microsecond=0)
+        if reported_until is None:
+            logging.info("No reported days to re-report")
+        else:
+            # all marked pods on the first run
+            since = read_timestamp(changes_timestamp_file)
+            logging.debug(f"Re-reporting pods modified from {since} to {until}")
+            report_changes(
+                since,
+                until,
+                reported_until,
+                accounting_url,
+                token,
+                flavor_config,
+                installation,
+                args.dry_run,
+                timeout,
+            )
+        if not args.dry_run:
+            write_timestamp(changes_timestamp_file, until)
 
     # ==== queries ====
     from_date, to_date = get_from_to_dates(args, timestamp_file)
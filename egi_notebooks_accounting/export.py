@@ -0,0 +1,232 @@
+"""Columnar export of the notebooks accounting db
+
+Completed records of the VM table are exported into Parquet (or Arrow IPC)
+files with typed columns, partitioned by the end day in Hive style
+directories (end_date=YYYY-MM-DD). Analysis tools can scan only the needed
+days and columns (or memory-map the Arrow files) without touching the live
+database, for example:
+
+    pandas.read_parquet(export_dir, columns=["global_user_name", "wall"],
+                        filters=[("end_date", ">=", "2026-01-01")])
+
+The export is incremental: only the days since the last exported partition
+are written (the last partition is rewritten, it could have been incomplete),
+together with the earlier days of the records modified since the last export
+(VM.modified, for example late harvested or reconciled pods). The time of the
+last export is kept in the export directory (the _modified file, ignored by
+the dataset readers). Partitions are kept when the records are archived from
+the database. Running pods are not exported.
+
+Requires pyarrow (pip install egi_notebooks_accounting[export]).
+
+Configuration:
+[default]
+notebooks_db=<notebooks db file>
+export_dir=<export directory>
+# parquet or arrow
+export_format=parquet
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from configparser import ConfigParser
+from datetime import date, datetime, timezone
+
+from peewee import FloatField, IntegerField, UUIDField
+
+from .model import VM, EpochField, db_init
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CONFIG = "default"
+DEFAULT_CONFIG_FILE = "config.ini"
+FORMATS = ["parquet", "arrow"]
+DEFAULT_FORMAT = "parquet"
+PARTITION = "end_date"
+# time of the last export (epoch), the modified records are exported again
+WATERMARK = "_modified"
+DAY = 86400
+
+
+def arrow_type(field):
+    if isinstance(field, EpochField):
+        return pyarrow.timestamp("s", tz="UTC")
+    if isinstance(field, FloatField):
+        return pyarrow.float64()
+    if isinstance(field, IntegerField):
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+def get_schema():
+    return pyarrow.schema(
+        [(field.name, arrow_type(field)) for field in VM._meta.sorted_fields]
+    )
+
+
+def partition_dir(export_dir, day):
+    return os.path.join(export_dir, f"{PARTITION}={day.isoformat()}")
+
+
+def last_partition(export_dir):
+    """The last exported day or None."""
+    days = []
+    if os.path.isdir(export_dir):
+        for name in os.listdir(export_dir):
+            key, _, value = name.partition("=")
+            if key == PARTITION:
+                days.append(date.fromisoformat(value))
+    return max(days, default=None)
+
+
+def read_watermark(export_dir):
+    """Time of the last export or None."""
+    try:
+        with open(os.path.join(export_dir, WATERMARK)) as f:
+            return int(f.read())
+    except (OSError, ValueError) as e:
+        logging.debug(f"No export watermark in '{export_dir}': {e}")
+    return None
+
+
+def write_watermark(export_dir, timestamp):
+    path = os.path.join(export_dir, WATERMARK)
+    with open(path + ".tmp", "w") as f:
+        f.write(str(timestamp))
+    os.replace(path + ".tmp", path)
+
+
+def get_days(since, modified_since=None):
+    """Days with completed records.
+
+    The records ending since the given day, or modified since the given
+    epoch time.
+    """
+    start = datetime.combine(since, datetime.min.time(), timezone.utc)
+    condition = VM.end_time >= start
+    if modified_since is not None:
+        condition |= VM.end_time.is_null(False) & (VM.modified >= modified_since)
+    query = (
+        VM.select((VM.end_time / DAY).alias("day"))
+        .where(condition)
+        .distinct()
+        .order_by(VM.end_time / DAY)
+    )
+    cursor = VM._meta.database.execute(query)
+    return [datetime.fromtimestamp(row[0] * DAY, timezone.utc).date() for row in cursor]
+
+
+def get_table(day):
+    """Records ending in the given day as Arrow table."""
+    fields = VM._meta.sorted_fields
+    start = int(datetime.combine(day, datetime.min.time(), timezone.utc).timestamp())
+    query = (
+        VM.select(*fields)
+        .where((VM.end_time >= start) & (VM.end_time < start + DAY))
+        .order_by(VM.end_time, VM.local_id)
+    )
+    columns = [[] for _ in fields]
+    for row in VM._meta.database.execute(query):
+        for column, value in zip(columns, row):
+            column.append(value)
+    for i, field in enumerate(fields):
+        if isinstance(field, UUIDField):
+            columns[i] = [str(field.python_value(v)) for v in columns[i]]
+    return pyarrow.table(columns, schema=get_schema())
+
+
+def write_table(table, path, fmt):
+    """Write the table atomically."""
+    tmp_path = path + ".tmp"
+    if fmt == "arrow":
+        # uncompressed to be able to memory-map the files
+        pyarrow.feather.write_feather(table, tmp_path, compression="uncompressed")
+    else:
+        pyarrow.parquet.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def export(export_dir, fmt=DEFAULT_FORMAT, since=None):
+    """Export partitions of the completed records.
+
+    :param since: first exported day (by default the last exported partition)
+
+    The days of the records modified since the last export are exported too.
+
+    Returns number of the exported records.
+    """
+    # before the queries, the records modified meanwhile are exported again
+    now = int(time.time())
+    if since is None:
+        since = last_partition(export_dir) or date.min
+    count = 0
+    for day in get_days(since, read_watermark(export_dir)):
+        table = get_table(day)
+        path = partition_dir(export_dir, day)
+        os.makedirs(path, exist_ok=True)
+        write_table(table, os.path.join(path, f"part-0.{fmt}"), fmt)
+        logging.debug(f"Exported {table.num_rows} records into '{path}'")
+        count += table.num_rows
+    os.makedirs(export_dir, exist_ok=True)
+    write_watermark(export_dir, now)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Notebooks accounting columnar export")
+    parser.add_argument(
+        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+    )
+    parser.add_argument("-o", "--export-dir", help="export directory")
+    parser.add_argument(
+        "--format", help=f"output format (default: {DEFAULT_FORMAT})", choices=FORMATS
+    )
+    parser.add_argument(
+        "--since",
+        help="export the days since the date (default: since the last exported day)",
+        type=date.fromisoformat,
+    )
+    args = parser.parse_args(argv)
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    config = parser[CONFIG] if CONFIG in parser else {}
+
+    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
+    verbose = logging.DEBUG if verbose == "1" else logging.INFO
+    logging.basicConfig(level=verbose)
+
+    if pyarrow is None:
+        logging.error("pyarrow is required for the export")
+        return 1
+    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+    export_dir = args.export_dir or os.environ.get(
+        "EXPORT_DIR", config.get("export_dir", None)
+    )
+    fmt = args.format or os.environ.get(
+        "EXPORT_FORMAT", config.get("export_format", DEFAULT_FORMAT)
+    )
+    if not db_file or not export_dir:
+        logging.error("Both notebooks_db and export_dir need to be configured")
+        return 1
+    if fmt not in FORMATS:
+        logging.error(f"Unknown export format '{fmt}'")
+        return 1
+
+    db = db_init(db_file)
+    with db.connection_context():
+        count = export(export_dir, fmt, args.since)
+    logging.info(f"Exported {count} records into '{export_dir}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
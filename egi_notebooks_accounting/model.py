@@ -1,9 +1,36 @@
+import logging
+import sys
+from array import array
+from datetime import datetime, timezone
+
 import peewee
-from peewee import CharField, DateTimeField, FloatField, IntegerField, UUIDField
+from peewee import BlobField, CharField, FloatField, IntegerField, UUIDField
 
 db = peewee.SqliteDatabase(None)
 
 
+class EpochField(IntegerField):
+    """Timestamp stored as integer seconds since the epoch.
+
+    Values are converted to timezone-aware datetimes in UTC.
+    """
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            # naive datetimes are UTC (the same as in the migration)
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return int(value.timestamp())
+        return int(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return datetime.fromtimestamp(value, timezone.utc)
+
+
 class BaseModel(peewee.Model):
 
     class Meta:
@@ -26,8 +53,8 @@ class VM(BaseModel):
     global_user_name = CharField(null=True)
     fqan = CharField(null=True)
     status = CharField(null=True)
-    start_time = DateTimeField(null=True)
-    end_time = DateTimeField(null=True)
+    start_time = EpochField(null=True, index=True)
+    end_time = EpochField(null=True, index=True)
     suspend_duration = FloatField(default=0, null=True)
     wall = FloatField(default=0, null=True)
     cpu_duration = FloatField(default=0, null=True)
@@ -43,6 +70,8 @@ class VM(BaseModel):
     benchmark = CharField(null=True)
     public_ip_count = IntegerField(default=0, null=True)
     flavor = CharField(null=True)
+    # last change of the reported fields (see pods.set_modified)
+    modified = EpochField(null=True, index=True)
 
     def as_dict(self):
         r = {
@@ -96,9 +125,145 @@ class VM(BaseModel):
         return "\n".join(record)
 
 
+class VMSeries(BaseModel):
+    """Hourly usage samples of the pod.
+
+    The samples are packed arrays of doubles (little endian), the first sample
+    is for the hour starting at start_time, missing samples are zeros.
+    """
+
+    HOUR = 3600
+    METRICS = ["cpu", "memory", "network_inbound", "network_outbound"]
+
+    local_id = UUIDField(primary_key=True)
+    start_time = EpochField(index=True)
+    end_time = EpochField(index=True)
+    cpu = BlobField(null=True)
+    memory = BlobField(null=True)
+    network_inbound = BlobField(null=True)
+    network_outbound = BlobField(null=True)
+
+    @staticmethod
+    def pack(values):
+        if sys.byteorder != "little":
+            values = array("d", values)
+            values.byteswap()
+        return values.tobytes()
+
+    @staticmethod
+    def unpack(blob):
+        values = array("d")
+        if blob:
+            values.frombytes(blob)
+            if sys.byteorder != "little":
+                values.byteswap()
+        return values
+
+    def get_array(self, metric):
+        """Samples of the metric as array, padded to the whole interval."""
+        values = VMSeries.unpack(getattr(self, metric))
+        hours = (
+            int(self.end_time.timestamp()) - int(self.start_time.timestamp())
+        ) // VMSeries.HOUR
+        if len(values) < hours:
+            values.extend([0.0] * (hours - len(values)))
+        return values
+
+
+class VMChange(BaseModel):
+    """Previously reported values of the modified pod.
+
+    The EOSC accounting re-reports the old values too (eosc --changed), for
+    example the hours of the pod under its old flavor.
+    """
+
+    local_id = UUIDField(index=True)
+    modified = EpochField(index=True)
+    global_user_name = CharField(null=True)
+    fqan = CharField(null=True)
+    flavor = CharField(null=True)
+    start_time = EpochField(null=True)
+    end_time = EpochField(null=True)
+
+
+MODELS = [VM, VMSeries, VMChange]
+
+
+def migrate_epoch(database):
+    """Convert start_time and end_time from text to integer epoch timestamps.
+
+    Naive times are considered to be in UTC.
+    """
+    for column in ("start_time", "end_time"):
+        database.execute_sql(
+            f'UPDATE "vm" SET "{column}" = CAST(strftime(\'%s\', "{column}") AS INTEGER)'
+            f" WHERE typeof(\"{column}\") = 'text'"
+        )
+
+
+def migrate_modified(database):
+    """Add the modification marker of the records.
+
+    The index is created with the new tables and indexes after the migrations.
+    """
+    database.execute_sql('ALTER TABLE "vm" ADD COLUMN "modified" INTEGER')
+
+
+def migrate_open_index(database):
+    """Drop the unused partial index of the open records.
+
+    The open records are searched by the end_time index (end_time IS NULL).
+    """
+    database.execute_sql('DROP INDEX IF EXISTS "vm_open"')
+
+
+# schema migrations, the item N upgrades the schema version N to N + 1
+MIGRATIONS = [
+    migrate_epoch,
+    migrate_modified,
+    migrate_open_index,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def db_setup(database):
+    """Create the tables or upgrade the schema of the existing database.
+
+    The schema version is kept in the SQLite user_version.
+    """
+    with database.bind_ctx(MODELS):
+        if not database.table_exists(VM._meta.table_name):
+            database.create_tables(MODELS)
+            database.user_version = SCHEMA_VERSION
+            return
+        version = database.user_version
+        if version < SCHEMA_VERSION:
+            with database.atomic():
+                for migration in MIGRATIONS[version:]:
+                    logging.info(
+                        f"Schema migration: {migration.__doc__.splitlines()[0]}"
+                    )
+                    migration(database)
+                database.user_version = SCHEMA_VERSION
+        # new tables and indexes added after the migrations
+        database.create_tables(MODELS)
+
+
 def db_init(db_file):
     db.init(db_file)
     db.connect()
-    db.create_tables([VM])
+    db_setup(db)
     db.close()
     return db
+
+
+def archive_db_init(archive_file):
+    """Initialize the archive database with completed records.
+
+    The archive has the same schema as the main database, but it is not bound
+    to the models (use bind_ctx() for queries).
+    """
+    archive_db = peewee.SqliteDatabase(archive_file)
+    db_setup(archive_db)
+    archive_db.close()
+    return archive_db
@@ -1,16 +1,20 @@
 import argparse
+import fnmatch
 import logging
 import os
+import re
 import time
 from configparser import ConfigParser
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List
 
 import peewee
-from dirq import QueueSimple
 
-from .model import VM, db_init
+from .model import VM, VMChange, db_init
 from .prometheus import Prometheus
+from .remote_read import RemoteReadError, parse_matchers
+from .series import query_series, save_series
+from .spool import DEFAULT_POLICY, Spool, parse_size
 
 CONFIG = "default"
 PROM_CONFIG = "prometheus"
@@ -18,89 +22,436 @@ DEFAULT_CONFIG_FILE = "config.ini"
 DEFAULT_FILTER = "pod=~'jupyter-.*'"
 DEFAULT_FQANS: Dict[str, List[str]] = {}
 DEFAULT_FQAN_KEY = "primary_group"
+# [VO] values with glob characters are patterns, or regular expressions
+FQAN_GLOB_CHARS = "*?["
+FQAN_REGEX_PREFIX = "re:"
 DEFAULT_RANGE = "24h"
+DEFAULT_SERIES = "0"
+DEFAULT_METADATA_CACHE = "0"
+STATUS_QUERY_RANGE = "range"
+STATUS_QUERY_REDUCED = "reduced"
+STATUS_QUERY_REMOTE_READ = "remote_read"
+DEFAULT_STATUS_QUERY = STATUS_QUERY_RANGE
+DEFAULT_STATUS_STEP = "30s"
+# pod metadata queries merged into one, the result series are tagged by label
+METADATA_LABEL = "accounting_metadata"
+METADATA_QUERIES = {
+    "created": "max by (namespace, pod, uid) (last_over_time(kube_pod_created{%s}[%s]))",
+    "annotations": "max by (namespace, pod, uid, annotation_hub_jupyter_org_username, annotation_egi_eu_primary_group, annotation_egi_eu_flavor)"
+    " (last_over_time(kube_pod_annotations{%s}[%s]))",
+    "image": "max by (namespace, pod, uid, image) (last_over_time(kube_pod_container_info{%s,container='notebook'}[%s]))",
+}
+# metadata of the known pods taken from the local database (the mapped fqan,
+# the primary group is not stored)
+METADATA_FIELDS = [VM.global_user_name, VM.fqan, VM.flavor, VM.image_id]
+# new pods per metadata query (uid=~ regex)
+METADATA_CHUNK = 100
+USAGE_QUERIES = {
+    "cpu_duration": "sum by (name) (max_over_time(container_cpu_usage_seconds_total{%s}[%s]))",
+    "cpu_count": "sum by (uid) (max_over_time(kube_pod_container_resource_requests{%s,resource='cpu'}[%s]))",
+    "memory": "sum by (name) (max_over_time(container_memory_max_usage_bytes{%s}[%s]))",
+    "network_inbound": "sum by (name) (last_over_time(container_network_receive_bytes_total{%s}[%s]))",
+    "network_outbound": "sum by (name) (last_over_time(container_network_transmit_bytes_total{%s}[%s]))",
+}
+# sharding by the last character of the pod name (DNS-1123 label)
+SHARD_BY_POD = "pod"
+SHARD_BY_NAMESPACE = "namespace"
+DEFAULT_SHARD_BY = SHARD_BY_POD
+DEFAULT_SHARDS = "1"
+POD_NAME_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+NAMESPACES_QUERY = "count by (namespace) (last_over_time(kube_pod_created{%s}[%s]))"
+# fields of the EOSC accounting, the pods are marked as modified on change
+REPORTED_FIELDS = [VM.start_time, VM.end_time, VM.global_user_name, VM.fqan, VM.flavor]
+# the previous values are kept on change of the reported cell or days (the
+# new end time is covered by the days of the modified pod)
+CHANGE_FIELDS = [VM.start_time, VM.global_user_name, VM.fqan, VM.flavor]
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Kubernetes Prometheus metrics harvester"
+class FqanMapping:
+    """Mapping of the fqan key values to VOs.
+
+    Values are exact, glob patterns, or regular expressions (with the "re:"
+    prefix). The patterns are compiled when added and tried in order, the
+    first matching pattern wins, the exact values are preferred. Results are
+    memoized per value, the patterns are evaluated once per distinct value.
+    """
+
+    def __init__(self, fqans=None):
+        self.exact = {}
+        self.patterns = []
+        self.cache = {}
+        for value, vo in (fqans or {}).items():
+            self.add(value, vo)
+
+    def add(self, value, vo):
+        if value.startswith(FQAN_REGEX_PREFIX):
+            pattern = re.compile(value.removeprefix(FQAN_REGEX_PREFIX))
+        elif any(c in value for c in FQAN_GLOB_CHARS):
+            pattern = re.compile(fnmatch.translate(value))
+        else:
+            self.exact[value] = vo
+            pattern = None
+        if pattern is not None:
+            self.patterns.append((pattern, vo))
+        self.cache = {}
+
+    def get(self, value):
+        """VO of the value (None if not mapped)."""
+        if value in self.cache:
+            return self.cache[value]
+        vo = self.exact.get(value)
+        if vo is None:
+            for pattern, pattern_vo in self.patterns:
+                if pattern.fullmatch(value):
+                    vo = pattern_vo
+                    break
+        self.cache[value] = vo
+        return vo
+
+    def __repr__(self):
+        patterns = {pattern.pattern: vo for pattern, vo in self.patterns}
+        return f"FqanMapping(exact={self.exact}, patterns={patterns})"
+
+
+def get_metadata_query(flt, rng, keys=METADATA_QUERIES):
+    """Single query for all the pod metadata (or only the given keys).
+
+    The metadata queries are joined by "or", the series of every query are
+    tagged by the METADATA_LABEL label. Only the needed labels are kept.
+    """
+    return " or ".join(
+        'label_replace(%s, "%s", "%s", "", "")'
+        % (METADATA_QUERIES[key] % (flt, rng), METADATA_LABEL, key)
+        for key in keys
     )
-    parser.add_argument(
-        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+
+
+def get_reduced_status_query(flt, rng, step):
+    """Query for the last running timestamp of each pod.
+
+    Prometheus evaluates the timestamp of the last sample with the Running
+    phase (subquery with the given step, which should not be longer than the
+    scrape interval), the latest sample is checked first. timestamp() is
+    applied on the selector to get the sample time, not the evaluation time
+    of the subquery step. Pods never seen running have the value 0.
+    """
+    phase = "kube_pod_status_phase{%s,phase='Running'}" % flt
+    running = "(timestamp(%s) and %s == 1)" % (phase, phase)
+    return "%s or max_over_time(%s[%s:%s]) or (last_over_time(%s[%s]) * 0)" % (
+        running,
+        running,
+        rng,
+        step,
+        phase,
+        rng,
     )
-    args = parser.parse_args()
 
-    parser = ConfigParser()
-    parser.read(args.config)
-    config = parser[CONFIG] if CONFIG in parser else {}
 
-    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
-    verbose = logging.DEBUG if verbose == "1" else logging.INFO
-    logging.basicConfig(level=verbose)
-    fqan_key = os.environ.get("FQAN_KEY", config.get("fqan_key", DEFAULT_FQAN_KEY))
-    spool_dir = os.environ.get("APEL_SPOOL", config.get("apel_spool"))
+def read_status(prom, flt, rng, tnow):
+    """Raw kube_pod_status_phase samples by the remote read API.
 
-    prom_config = parser[PROM_CONFIG] if PROM_CONFIG in parser else {}
-    flt = os.environ.get("FILTER", prom_config.get("filter", DEFAULT_FILTER))
-    rng = os.environ.get("RANGE", prom_config.get("range", DEFAULT_RANGE))
-    usage_queries = {
-        "cpu_duration": "sum by (name) (max_over_time(container_cpu_usage_seconds_total{%s}[%s]))"
-        % (flt, rng),
-        "cpu_count": "sum by (uid) (max_over_time(kube_pod_container_resource_requests{%s,resource='cpu'}[%s]))"
-        % (flt, rng),
-        "memory": "sum by (name) (max_over_time(container_memory_max_usage_bytes{%s}[%s]))"
-        % (flt, rng),
-        "network_inbound": "sum by (name) (last_over_time(container_network_receive_bytes_total{%s}[%s]))"
-        % (flt, rng),
-        "network_outbound": "sum by (name) (last_over_time(container_network_transmit_bytes_total{%s}[%s]))"
-        % (flt, rng),
-    }
+    Returns the series as items of an instant query result, the value is the
+    time of the last running sample (0 if not running), the same as the
+    reduced status query.
+    """
+    matchers = parse_matchers(flt) + [
+        ("__name__", "=", "kube_pod_status_phase"),
+        ("phase", "=", "Running"),
+    ]
+    start = tnow - prom.parse_range(rng).total_seconds()
+    return [
+        {"metric": labels, "value": [tnow, str(last or 0)]}
+        for labels, last in prom.read(matchers, start, tnow).last_times()
+    ]
 
-    VM.site = os.environ.get("SITENAME", config.get("site", VM.site))
-    VM.cloud_type = os.environ.get(
-        "CLOUD_TYPE", config.get("cloud_type", VM.cloud_type)
-    )
-    VM.cloud_compute_service = os.environ.get(
-        "SERVICE", config.get("cloud_compute_service", VM.cloud_compute_service)
+
+def split_metadata(result):
+    """Demultiplex the result of the merged metadata query.
+
+    Returns dictionary {metadata key: list of series}.
+    """
+    metadata = {key: [] for key in METADATA_QUERIES}
+    for item in result:
+        key = item["metric"].get(METADATA_LABEL)
+        if key in metadata:
+            metadata[key].append(item)
+    return metadata
+
+
+def get_last_running(values):
+    """Timestamp of the last sample with the pod running (value 1).
+
+    The samples are scanned from the end, only the trailing samples after
+    the last running phase are visited. Returns None if the pod has never
+    been seen running.
+    """
+    for timestamp, value in reversed(values):
+        if value == "1":
+            return int(timestamp)
+    return None
+
+
+def update_status(pod, last_running, tnow):
+    """Set end time, status, and wall of the pod from its last running time."""
+    # last timestamp, status, and wall
+    # (wall would be summary for value==1, but the initial metrics may be lost for long-term notebooks ==> better to use time from kube_pod_created here)
+    if last_running is not None:
+        pod.end_time = datetime.fromtimestamp(last_running, timezone.utc)
+        # status (check the last running phase)
+        if tnow - last_running > 1.5 * 60:
+            pod.status = "completed"
+        else:
+            pod.end_time = None
+            pod.status = "started"
+        pod.wall = last_running - pod.start_time.timestamp()
+    else:
+        # no value==1 with phase="Running" has been scrubbed
+        # => probably ended too fast or it"s recent launch
+        pod.wall = 0
+        if tnow - pod.start_time.timestamp() < 1.6 * 60:
+            # consider it as recent launch
+            pod.status = "started"
+        else:
+            pod.end_time = pod.start_time
+            pod.status = "completed"
+
+
+def get_stored_pods(uids):
+    """Load the stored records of the pods in bulk."""
+    stored = {}
+    for chunk in peewee.chunked(uids, 500):
+        for pod in VM.select().where(VM.local_id.in_(chunk)):
+            stored[str(pod.local_id)] = pod
+    return stored
+
+
+def load_metadata(pods):
+    """Copy the metadata of the already known pods from their stored records.
+
+    Returns the uids of the pods still needing the metadata queries: the new
+    pods and the pods stored before their annotations have been scraped.
+    """
+    stored = get_stored_pods(pods.keys())
+    new = []
+    for uid, pod in pods.items():
+        stored_pod = stored.get(uid)
+        if stored_pod is None or stored_pod.global_user_name is None:
+            new.append(uid)
+            continue
+        for field in METADATA_FIELDS:
+            setattr(pod, field.name, getattr(stored_pod, field.name))
+    return new
+
+
+def is_unchanged(pod, stored_pod, fields=None):
+    """Compare the pod with its stored record (None for a new pod).
+
+    The modification marker is not compared.
+    """
+    if stored_pod is None:
+        return False
+    if fields is None:
+        fields = [f for f in VM._meta.sorted_fields if f is not VM.modified]
+    return all(
+        field.db_value(getattr(pod, field.name))
+        == field.db_value(getattr(stored_pod, field.name))
+        for field in fields
     )
-    VM.default_cpu_count = os.environ.get(
-        "DEFAULT_CPU_COUNT",
-        config.get("default_cpu_count", VM.default_cpu_count),
+
+
+def set_modified(pods, stored, now):
+    """Mark the new pods and the pods with changed reported fields.
+
+    The EOSC accounting re-reports the days affected by the marked pods
+    (eosc --changed), the other pods keep the stored marker.
+    """
+    for uid, pod in pods.items():
+        stored_pod = stored.get(uid)
+        if is_unchanged(pod, stored_pod, REPORTED_FIELDS):
+            pod.modified = stored_pod.modified
+        else:
+            pod.modified = now
+
+
+def write_spool(spool, pods):
+    """Dump the pods valid for APEL into the spool dir as one message.
+
+    Returns False if the message has been refused by the spool limits.
+    """
+    records = {uid: pod.dump() for uid, pod in pods.items() if pod.valid_apel()}
+    if not records:
+        logging.debug("No records for spool dir")
+        spool.write_metrics()
+        return True
+    if not spool.add(records):
+        return False
+    logging.debug("Dumped %d records to spool dir", len(records))
+    return True
+
+
+def save_pods(db, pods, stored):
+    """Insert new and update already stored pods in one transaction.
+
+    The previously reported values of the changed pods are kept in VMChange.
+    """
+    with db.atomic():
+        for uid, pod in pods.items():
+            if uid in stored:
+                stored_pod = stored[uid]
+                if not is_unchanged(pod, stored_pod, CHANGE_FIELDS):
+                    VMChange.create(
+                        local_id=pod.local_id,
+                        modified=pod.modified,
+                        global_user_name=stored_pod.global_user_name,
+                        fqan=stored_pod.fqan,
+                        flavor=stored_pod.flavor,
+                        start_time=stored_pod.start_time,
+                        end_time=stored_pod.end_time,
+                    )
+                pod.save()
+            else:
+                pod.save(force_insert=True)
+
+
+def match_labels(matchers, pod):
+    """Evaluate the namespace and pod label matchers on the stored record.
+
+    The other labels are not stored, their matchers are ignored.
+    """
+    labels = {"namespace": pod.namespace, "pod": pod.machine}
+    for name, op, value in matchers:
+        if name not in labels:
+            continue
+        if op in ("=", "!="):
+            matched = labels[name] == value
+        else:
+            matched = re.fullmatch(value, labels[name] or "") is not None
+        if matched != (op in ("=", "=~")):
+            return False
+    return True
+
+
+def get_stale_pods(matchers, seen, before):
+    """Open records matching the filter not seen by the harvest.
+
+    Only the records last observed (start time + wall) before the given epoch
+    time are returned, Prometheus would return the pods seen since then.
+    """
+    stale = {}
+    query = VM.select().where(
+        VM.end_time.is_null() & ((VM.start_time + VM.wall) < before)
     )
-    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+    for pod in query:
+        uid = str(pod.local_id)
+        if uid not in seen and match_labels(matchers, pod):
+            stale[uid] = pod
+    return stale
 
-    fqans = dict(DEFAULT_FQANS)
-    if "VO" in parser:
-        vo_config = parser["VO"]
-        for vo, values in vo_config.items():
-            for value in values.split(","):
-                fqans[value] = vo
-    logging.debug("FQAN: %s", fqans)
 
-    db = None
-    if db_file:
-        db = db_init(db_file)
-        db.connect()
-    prom = Prometheus(parser)
-    tnow = time.time()
-    data = {
-        "time": tnow,
-    }
+def reconcile(db, spool, matchers, shard_matchers, stale, before, harvested):
+    """Close the stale open records at their last observed time.
 
-    # ==== START, MACHINE, VO ====
-    data["query"] = "last_over_time(kube_pod_created{" + flt + "}[" + rng + "])"
+    The stale records of the harvested shards are in stale, the records
+    outside of all shards (namespaces without pods) are added here. Nothing
+    is closed if no pods have been harvested at all (metrics not available).
+    """
+    for uid, pod in get_stale_pods(matchers, {}, before).items():
+        if not any(match_labels(m, pod) for m in shard_matchers):
+            stale[uid] = pod
+    if not stale:
+        return
+    if not harvested:
+        logging.warning("No pods harvested, %d open records kept", len(stale))
+        return
+    for pod in stale.values():
+        pod.end_time = pod.start_time + timedelta(seconds=pod.wall or 0)
+        pod.status = "completed"
+    logging.info("Closing %d open records of the pods not seen anymore", len(stale))
+    flush(db, spool, stale, {})
+
+
+def get_shard_filters(prom, data, flt, rng, shard_by=DEFAULT_SHARD_BY, shards=1):
+    """Split the filter into the shards harvested one after another.
+
+    Pods are split by the last character of their name into the given number
+    of shards, or by namespace (each namespace with pods is one shard).
+    """
+    if shard_by == SHARD_BY_NAMESPACE:
+        data["query"] = NAMESPACES_QUERY % (flt, rng)
+        response = prom.query(data)
+        namespaces = sorted(
+            item["metric"]["namespace"]
+            for item in response["data"]["result"]
+            if "namespace" in item["metric"]
+        )
+        return ["%s,namespace='%s'" % (flt, namespace) for namespace in namespaces]
+    if shard_by != SHARD_BY_POD:
+        raise ValueError(f"Unknown shard_by '{shard_by}'")
+    shards = min(shards, len(POD_NAME_CHARS))
+    if shards <= 1:
+        return [flt]
+    return [
+        "%s,pod=~'.*[%s]'" % (flt, POD_NAME_CHARS[i::shards]) for i in range(shards)
+    ]
+
+
+def harvest(
+    prom,
+    data,
+    flt,
+    rng,
+    status_query,
+    status_step,
+    fqan_key,
+    fqans,
+    series=False,
+    metadata_cache=False,
+):
+    """Harvest the pods matching the filter into prom.pods.
+
+    With the metadata cache, the annotations and the image are queried only
+    for the pods not known in the local database.
+
+    Returns hourly usage series of the pods (empty if series are disabled).
+    """
+    tnow = data["time"]
+    # ==== pod metadata (single query) ====
+    if metadata_cache:
+        data["query"] = get_metadata_query(flt, rng, ["created"])
+    else:
+        data["query"] = get_metadata_query(flt, rng)
     response = prom.query(data)
-    for item in response["data"]["result"]:
+    metadata = split_metadata(response["data"]["result"])
+    # ==== START, MACHINE, VO ====
+    for item in metadata["created"]:
         # print(item)
         pod = prom.get_pod(item, uid=None, default=VM())
         metric = item["metric"]
-        pod.start_time = datetime.fromtimestamp(int(item["value"][1]))
+        pod.start_time = datetime.fromtimestamp(int(item["value"][1]), timezone.utc)
         pod.machine = metric["pod"]
         pod.namespace = metric["namespace"]
+    if metadata_cache:
+        new = load_metadata(prom.pods)
+        logging.debug("%d pods without cached metadata", len(new))
+        for chunk in peewee.chunked(sorted(new), METADATA_CHUNK):
+            data["query"] = get_metadata_query(
+                "%s,uid=~'%s'" % (flt, "|".join(chunk)), rng, ["annotations", "image"]
+            )
+            response = prom.query(data)
+            for key, items in split_metadata(response["data"]["result"]).items():
+                metadata[key].extend(items)
     # ==== END, WALL ====
-    data["query"] = "kube_pod_status_phase{" + flt + ",phase='Running'}[" + rng + "]"
-    response = prom.query(data)
-    for item in response["data"]["result"]:
+    if status_query == STATUS_QUERY_REMOTE_READ:
+        result = read_status(prom, flt, rng, tnow)
+    else:
+        if status_query == STATUS_QUERY_REDUCED:
+            data["query"] = get_reduced_status_query(flt, rng, status_step)
+        else:
+            data["query"] = (
+                "kube_pod_status_phase{" + flt + ",phase='Running'}[" + rng + "]"
+            )
+        result = prom.query(data)["data"]["result"]
+    for item in result:
         # print(item)
         pod = prom.get_pod(item)
         metric = item["metric"]
@@ -112,32 +463,13 @@ def main():
                 metric["uid"],
             )
             continue
-        running = [v[0] for v in item["values"] if v[1] == "1"]
-        # last timestamp, status, and wall
-        # (wall would be summary for value==1, but the initial metrics may be lost for long-term notebooks ==> better to use time from kube_pod_created here)
-        if len(running) > 0:
-            pod.end_time = datetime.fromtimestamp(int(running[-1]))
-            # status (check the last running phase)
-            if tnow - pod.end_time.timestamp() > 1.5 * 60:
-                pod.status = "completed"
-            else:
-                pod.end_time = None
-                pod.status = "started"
-            pod.wall = int(running[-1]) - pod.start_time.timestamp()
+        if status_query in (STATUS_QUERY_REDUCED, STATUS_QUERY_REMOTE_READ):
+            last_running = int(float(item["value"][1])) or None
         else:
-            # no value==1 with phase="Running" has been scrubbed
-            # => probably ended too fast or it"s recent launch
-            pod.wall = 0
-            if tnow - pod.start_time.timestamp() < 1.6 * 60:
-                # consider it as recent launch
-                pod.status = "started"
-            else:
-                pod.end_time = pod.start_time
-                pod.status = "completed"
+            last_running = get_last_running(item["values"])
+        update_status(pod, last_running, tnow)
     # ==== USER ====
-    data["query"] = "last_over_time(kube_pod_annotations{" + flt + "}[" + rng + "])"
-    response = prom.query(data)
-    for item in response["data"]["result"]:
+    for item in metadata["annotations"]:
         pod = prom.get_pod(item)
         metric = item["metric"]
         if pod is None:
@@ -152,15 +484,7 @@ def main():
         pod.primary_group = metric.get("annotation_egi_eu_primary_group", None)
         pod.flavor = metric.get("annotation_egi_eu_flavor", None)
     # ==== IMAGE ====
-    data["query"] = (
-        "last_over_time(kube_pod_container_info{"
-        + flt
-        + ",container='notebook'}["
-        + rng
-        + "])"
-    )
-    response = prom.query(data)
-    for item in response["data"]["result"]:
+    for item in metadata["image"]:
         pod = prom.get_pod(item)
         metric = item["metric"]
         if pod is None:
@@ -174,8 +498,8 @@ def main():
         if "image" in metric:
             pod.image_id = metric["image"]
     # ==== resource usage queries ====
-    for field, query in usage_queries.items():
-        data["query"] = query
+    for field, query in USAGE_QUERIES.items():
+        data["query"] = query % (flt, rng)
         response = prom.query(data)
         for item in response["data"]["result"]:
             # print(item)
@@ -194,32 +518,169 @@ def main():
             value = float(item["value"][1])
             item = getattr(pod, field)
             setattr(pod, field, item + value)
+    # ==== hourly usage series ====
+    pod_series = {}
+    if series:
+        pod_series = query_series(prom, data, flt, rng)
     # ==== FQANS postprocessing ====
     for pod in prom.pods.values():
         fqan_value = getattr(pod, fqan_key, None)
         logging.debug(
             "fqan evaluation: pod %s, fqan_value %s", pod.local_id, fqan_value
         )
-        if fqan_value in fqans:
-            pod.fqan = vo
-        elif fqan_value:
-            # just use the value that's in the pod
-            pod.fqan = fqan_value
-
-    if prom.pods:
-        if spool_dir:
-            queue = QueueSimple.QueueSimple(spool_dir)
-            message = "APEL-cloud-message: v0.4\n" + "\n%%\n".join(
-                (pod.dump() for (uid, pod) in prom.pods.items() if pod.valid_apel())
-            )
-            queue.add(message)
-            logging.debug("Dumped %d records to spool dir", len(prom.pods))
-        if db:
-            for uid, pod in prom.pods.items():
-                try:
-                    pod.save(force_insert=True)
-                except peewee.IntegrityError:
-                    pod.save()
+        if fqan_value:
+            # resolved once per distinct value, unmapped values are used as
+            # they are
+            pod.fqan = fqans.get(fqan_value) or fqan_value
+
+    return pod_series
+
+
+def flush(db, spool, pods, pod_series):
+    """Write the changed pods into the spool dir and the database."""
+    stored = {}
+    if db:
+        stored = get_stored_pods(pods.keys())
+        changed = {
+            uid: pod
+            for uid, pod in pods.items()
+            if pod.status != "completed" or not is_unchanged(pod, stored.get(uid))
+        }
+        logging.debug("%d changed pods from %d", len(changed), len(pods))
+        pods = changed
+        set_modified(pods, stored, datetime.now(timezone.utc))
+    if spool and not write_spool(spool, pods):
+        # refused completed pods are not stored, they would be skipped as
+        # unchanged and never queued again
+        pods = {
+            uid: pod
+            for uid, pod in pods.items()
+            if pod.status != "completed" or not pod.valid_apel()
+        }
+    if db:
+        save_pods(db, pods, stored)
+        save_series({uid: s for uid, s in pod_series.items() if uid in pods})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Kubernetes Prometheus metrics harvester"
+    )
+    parser.add_argument(
+        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+    )
+    args = parser.parse_args(argv)
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    config = parser[CONFIG] if CONFIG in parser else {}
+
+    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
+    verbose = logging.DEBUG if verbose == "1" else logging.INFO
+    logging.basicConfig(level=verbose)
+    fqan_key = os.environ.get("FQAN_KEY", config.get("fqan_key", DEFAULT_FQAN_KEY))
+    spool_dir = os.environ.get("APEL_SPOOL", config.get("apel_spool"))
+    spool = None
+    if spool_dir:
+        spool = Spool(
+            spool_dir,
+            max_messages=int(
+                os.environ.get(
+                    "APEL_SPOOL_MAX_MESSAGES", config.get("apel_spool_max_messages", 0)
+                )
+            ),
+            max_size=parse_size(
+                os.environ.get(
+                    "APEL_SPOOL_MAX_SIZE", config.get("apel_spool_max_size", 0)
+                )
+            ),
+            policy=os.environ.get(
+                "APEL_SPOOL_POLICY", config.get("apel_spool_policy", DEFAULT_POLICY)
+            ),
+            metrics_file=os.environ.get(
+                "APEL_SPOOL_METRICS", config.get("apel_spool_metrics")
+            ),
+        )
+
+    prom_config = parser[PROM_CONFIG] if PROM_CONFIG in parser else {}
+    flt = os.environ.get("FILTER", prom_config.get("filter", DEFAULT_FILTER))
+    rng = os.environ.get("RANGE", prom_config.get("range", DEFAULT_RANGE))
+    series = os.environ.get("SERIES", prom_config.get("series", DEFAULT_SERIES))
+    metadata_cache = os.environ.get(
+        "METADATA_CACHE", prom_config.get("metadata_cache", DEFAULT_METADATA_CACHE)
+    )
+    status_query = os.environ.get(
+        "STATUS_QUERY", prom_config.get("status_query", DEFAULT_STATUS_QUERY)
+    )
+    status_step = os.environ.get(
+        "STATUS_STEP", prom_config.get("status_step", DEFAULT_STATUS_STEP)
+    )
+    shard_by = os.environ.get("SHARD_BY", prom_config.get("shard_by", DEFAULT_SHARD_BY))
+    shards = int(os.environ.get("SHARDS", prom_config.get("shards", DEFAULT_SHARDS)))
+    VM.site = os.environ.get("SITENAME", config.get("site", VM.site))
+    VM.cloud_type = os.environ.get(
+        "CLOUD_TYPE", config.get("cloud_type", VM.cloud_type)
+    )
+    VM.cloud_compute_service = os.environ.get(
+        "SERVICE", config.get("cloud_compute_service", VM.cloud_compute_service)
+    )
+    VM.default_cpu_count = os.environ.get(
+        "DEFAULT_CPU_COUNT",
+        config.get("default_cpu_count", VM.default_cpu_count),
+    )
+    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+
+    fqans = FqanMapping(DEFAULT_FQANS)
+    if "VO" in parser:
+        vo_config = parser["VO"]
+        for vo, values in vo_config.items():
+            for value in values.split(","):
+                fqans.add(value, vo)
+    logging.debug("FQAN: %s", fqans)
+
+    db = None
+    if db_file:
+        db = db_init(db_file)
+        db.connect()
+    prom = Prometheus(parser)
+    tnow = time.time()
+    data = {
+        "time": tnow,
+    }
+    matchers = None
+    if db:
+        try:
+            matchers = parse_matchers(flt)
+        except RemoteReadError as e:
+            logging.warning(f"Open records not reconciled: {e}")
+    # records not seen in the whole range are stale
+    before = int(tnow - prom.parse_range(rng).total_seconds())
+    shard_matchers = []
+    stale = {}
+    harvested = 0
+
+    for shard_flt in get_shard_filters(prom, data, flt, rng, shard_by, shards):
+        prom.pods = {}
+        pod_series = harvest(
+            prom,
+            data,
+            shard_flt,
+            rng,
+            status_query,
+            status_step,
+            fqan_key,
+            fqans,
+            db is not None and series == "1",
+            db is not None and metadata_cache == "1",
+        )
+        harvested += len(prom.pods)
+        if matchers is not None:
+            shard_matchers.append(parse_matchers(shard_flt))
+            stale.update(get_stale_pods(shard_matchers[-1], prom.pods, before))
+        if prom.pods:
+            flush(db, spool, prom.pods, pod_series)
+    if matchers is not None:
+        reconcile(db, spool, matchers, shard_matchers, stale, before, harvested)
     if db:
         db.close()
 
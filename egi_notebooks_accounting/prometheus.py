@@ -12,6 +12,15 @@ from requests.auth import HTTPBasicAuth
 # urllib3 1.9.1: from urllib3.exceptions import InsecureRequestWarning
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+from .remote_read import (
+    STREAMED_CONTENT_TYPE,
+    SeriesSet,
+    encode_read_request,
+    iter_frames,
+    snappy_compress,
+    snappy_decompress,
+)
+
 CONFIG = "prometheus"
 DEFAULT_PROMETHEUS_URL = "http://localhost:8080"
 
@@ -20,6 +29,12 @@ class Prometheus:
     DEFAULT_AGENT = "egi-notebooks-client/1.0-dev"
     DEFAULT_HEADERS = {"User-Agent": DEFAULT_AGENT}
     DEFAULT_HEADERS_MIME = {"Content-Type": "application/x-www-form-urlencoded"}
+    REMOTE_READ_HEADERS = {
+        "Content-Encoding": "snappy",
+        "Content-Type": "application/x-protobuf",
+        "X-Prometheus-Remote-Read-Version": "0.1.0",
+    }
+    REMOTE_READ_CHUNK = 65536
 
     def __init__(self, parser):
         config = parser[CONFIG] if CONFIG in parser else {}
@@ -67,6 +82,35 @@ class Prometheus:
         response = self.post("/query", data=data)
         return json.loads(str(response.content, "utf-8"))
 
+    def read(self, matchers, start, end):
+        """Fetch raw samples by the remote read API.
+
+        :param matchers: list of (name, operator, value) label matchers
+        :param start: epoch time in seconds
+        :param end: epoch time in seconds
+
+        Returns SeriesSet, the XOR chunks are decoded on demand.
+        """
+        data = encode_read_request(matchers, int(start * 1000), int(end * 1000))
+        logging.debug("READ %s", matchers)
+        response = self.session.post(
+            self.url + "/read",
+            data=snappy_compress(data),
+            headers=Prometheus.REMOTE_READ_HEADERS,
+            stream=True,
+        )
+        self.handle_error(response)
+        series = SeriesSet()
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith(STREAMED_CONTENT_TYPE):
+            for message in iter_frames(
+                response.iter_content(Prometheus.REMOTE_READ_CHUNK)
+            ):
+                series.add_chunked(message)
+        else:
+            series.add_samples(snappy_decompress(response.content))
+        return series
+
     def get_pod(self, item, uid=None, default=None):
         if "metric" not in item or uid is None and "uid" not in item["metric"]:
             logging.error("missing metric or uid in metric")
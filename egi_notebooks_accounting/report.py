@@ -0,0 +1,282 @@
+"""Ad-hoc usage reports from the notebooks accounting db
+
+Aggregates the running time of the pods stored in the local accounting db
+over an arbitrary time window. The window is split into buckets (hour, day,
+week, month or the whole window) and the usage is grouped by any combination
+of user, fqan, flavor, namespace and image.
+
+The running time of every pod is clamped to the window and buckets the same
+way as the EOSC accounting does (see eosc.update_pod_metric).
+
+The archive database with the older records can be included too (--archive).
+
+Output is CSV or JSON with the rows:
+
+period_start, period_end, <grouping fields>, pods, hours[, cpu_hours]
+
+CPU hours are computed from the stored hourly usage series (--cpu), the hourly
+samples are accounted into the bucket containing the start of the hour.
+
+Configuration:
+[default]
+notebooks_db=<notebooks db file>
+archive_db=<archive db file>
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import logging
+import os
+import sys
+from collections import namedtuple
+from configparser import ConfigParser
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+from dateutil.relativedelta import relativedelta
+
+from .eosc import get_pod_interval
+from .model import MODELS, VM, VMSeries, archive_db_init, db_init
+from .series import sum_buckets
+
+CONFIG = "default"
+DEFAULT_CONFIG_FILE = "config.ini"
+DEFAULT_BUCKET = "day"
+DEFAULT_FORMAT = "csv"
+DEFAULT_GROUP_BY = "user,fqan,flavor"
+DEFAULT_DAYS = 30
+GROUP_FIELDS = {
+    "user": VM.global_user_name,
+    "fqan": VM.fqan,
+    "flavor": VM.flavor,
+    "namespace": VM.namespace,
+    "image": VM.image_id,
+}
+BUCKETS = ["hour", "day", "week", "month", "total"]
+FORMATS = ["csv", "json"]
+
+
+def parse_date(value):
+    """Parse the date, naive dates are considered to be in UTC."""
+    date = dateutil.parser.parse(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def get_bucket_edges(from_date, to_date, bucket):
+    """Split the window into buckets.
+
+    Returns sorted list of the bucket edges, the first one is from_date and
+    the last one is to_date.
+    """
+    steps = {
+        "hour": relativedelta(hours=1),
+        "day": relativedelta(days=1),
+        "week": relativedelta(weeks=1),
+        # clamped to the end of shorter months
+        "month": relativedelta(months=1),
+    }
+    edges = [from_date]
+    if bucket in steps:
+        n = 1
+        # each edge from the start, so the clamped days do not accumulate
+        while (current := from_date + n * steps[bucket]) < to_date:
+            edges.append(current)
+            n += 1
+    edges.append(to_date)
+    return edges
+
+
+def select_pods(from_date, to_date, fields):
+    """Pods running anytime in between the dates.
+
+    The window is searched by two queries so both can use the indexes on
+    start_time and end_time columns. Rows are not converted by the model,
+    the times are kept as integer epoch timestamps.
+    """
+    columns = [VM.start_time, VM.end_time] + fields
+    Row = namedtuple("Row", [column.name for column in columns])
+    queries = [
+        # pods ending in the window or later
+        VM.select(*columns).where(
+            (VM.end_time >= from_date)
+            & (VM.start_time.is_null() | (VM.start_time < to_date))
+        ),
+        # pods still running
+        VM.select(*columns).where(VM.end_time.is_null() & (VM.start_time < to_date)),
+    ]
+    for query in queries:
+        yield from map(Row._make, VM._meta.database.execute(query))
+
+
+def aggregate(pods, edges, group_by, report=None):
+    """Sum up running time of the pods per bucket and group.
+
+    Returns dictionary {(bucket index, group values): [pods, seconds, cpu]},
+    the existing report is updated if specified.
+    """
+    if report is None:
+        report = {}
+    stamps = [int(edge.timestamp()) for edge in edges]
+    last = len(stamps) - 1
+    for pod in pods:
+        start, end = get_pod_interval(pod, stamps[0], stamps[-1])
+        key = tuple(getattr(pod, GROUP_FIELDS[group].name) for group in group_by)
+        i = bisect.bisect_right(stamps, start) - 1
+        while True:
+            seconds = max(0, min(end, stamps[i + 1]) - max(start, stamps[i]))
+            cell = report.setdefault((i, key), [0, 0, 0])
+            cell[0] += 1
+            cell[1] += seconds
+            i += 1
+            if i >= last or stamps[i] >= end:
+                break
+    return report
+
+
+def aggregate_cpu(edges, group_by, fields, report):
+    """Sum up CPU time from the hourly series per bucket and group."""
+    stamps = [int(edge.timestamp()) for edge in edges]
+    query = (
+        VMSeries.select(VMSeries.start_time, VMSeries.end_time, VMSeries.cpu, *fields)
+        .join(VM, on=(VMSeries.local_id == VM.local_id))
+        .where((VMSeries.start_time < edges[-1]) & (VMSeries.end_time > edges[0]))
+        .objects()
+    )
+    for row in query.iterator():
+        key = tuple(getattr(row, GROUP_FIELDS[group].name) for group in group_by)
+        totals = sum_buckets(row, "cpu", stamps, [0] * (len(stamps) - 1))
+        for i, value in enumerate(totals):
+            if value:
+                cell = report.setdefault((i, key), [0, 0, 0])
+                cell[2] += value
+    return report
+
+
+def get_rows(report, edges, group_by, cpu=False):
+    rows = []
+    for (i, key), (count, seconds, cpu_seconds) in sorted(
+        report.items(), key=lambda item: (item[0][0], [str(k) for k in item[0][1]])
+    ):
+        row = {
+            "period_start": edges[i].strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "period_end": edges[i + 1].strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        row.update(zip(group_by, key))
+        row["pods"] = count
+        row["hours"] = seconds / (60 * 60)
+        if cpu:
+            row["cpu_hours"] = cpu_seconds / (60 * 60)
+        rows.append(row)
+    return rows
+
+
+def write_rows(rows, group_by, fmt, output, cpu=False):
+    if fmt == "json":
+        json.dump(rows, output, indent=2)
+        output.write("\n")
+    else:
+        fieldnames = ["period_start", "period_end"] + group_by + ["pods", "hours"]
+        if cpu:
+            fieldnames.append("cpu_hours")
+        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Notebooks usage report")
+    parser.add_argument(
+        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+    )
+    parser.add_argument(
+        "--from-date",
+        help=f"Start date to report from (default: {DEFAULT_DAYS} days ago)",
+    )
+    parser.add_argument(
+        "--to-date", help="End date to report to (default: today midnight)"
+    )
+    parser.add_argument(
+        "--group-by",
+        help=f"Comma separated list of {', '.join(GROUP_FIELDS)} (default: {DEFAULT_GROUP_BY})",
+        default=DEFAULT_GROUP_BY,
+    )
+    parser.add_argument(
+        "--bucket", help="Bucket size", choices=BUCKETS, default=DEFAULT_BUCKET
+    )
+    parser.add_argument(
+        "--format", help="Output format", choices=FORMATS, default=DEFAULT_FORMAT
+    )
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser.add_argument(
+        "--cpu", help="Include CPU hours from the hourly series", action="store_true"
+    )
+    parser.add_argument("--archive", help="Include the archive db", action="store_true")
+    parser.add_argument("--archive-db", help="archive db file")
+    args = parser.parse_args(argv)
+
+    group_by = [group.strip() for group in args.group_by.split(",") if group.strip()]
+    for group in group_by:
+        if group not in GROUP_FIELDS:
+            parser.error(f"unknown grouping '{group}'")
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    config = parser[CONFIG] if CONFIG in parser else {}
+
+    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
+    verbose = logging.DEBUG if verbose == "1" else logging.INFO
+    logging.basicConfig(level=verbose)
+
+    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+    db = db_init(db_file)
+
+    if args.to_date:
+        to_date = parse_date(args.to_date)
+    else:
+        to_date = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+    if args.from_date:
+        from_date = parse_date(args.from_date)
+    else:
+        from_date = to_date - timedelta(days=DEFAULT_DAYS)
+    logging.debug(f"Reporting from {from_date} to {to_date}")
+    if from_date >= to_date:
+        logging.error("Empty reporting window")
+        return 1
+
+    edges = get_bucket_edges(from_date, to_date, args.bucket)
+    fields = [GROUP_FIELDS[group] for group in group_by]
+    with db.connection_context():
+        report = aggregate(select_pods(from_date, to_date, fields), edges, group_by)
+        if args.cpu:
+            aggregate_cpu(edges, group_by, fields, report)
+    if args.archive or args.archive_db:
+        archive_file = args.archive_db or os.environ.get(
+            "ARCHIVE_DB", config.get("archive_db", None)
+        )
+        if not archive_file:
+            logging.error("Archive db not configured")
+            return 1
+        archive_db = archive_db_init(archive_file)
+        with archive_db.bind_ctx(MODELS), archive_db.connection_context():
+            aggregate(select_pods(from_date, to_date, fields), edges, group_by, report)
+            if args.cpu:
+                aggregate_cpu(edges, group_by, fields, report)
+    rows = get_rows(report, edges, group_by, args.cpu)
+    logging.debug(f"=> {len(rows)} rows")
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_rows(rows, group_by, args.format, output, args.cpu)
+    else:
+        write_rows(rows, group_by, args.format, sys.stdout, args.cpu)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
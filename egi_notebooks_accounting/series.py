@@ -0,0 +1,128 @@
+"""Hourly usage series of the pods
+
+Besides the run-wide totals in the VM table, the harvester stores hourly
+samples of CPU time, memory and network usage of every pod (see
+model.VMSeries). The samples are queried from Prometheus as subqueries with
+one hour resolution, so the samples are aligned to whole hours.
+
+Every harvest run overlaps the previous ones, the new samples are merged into
+the stored series (the newer values have precedence).
+"""
+
+import bisect
+import logging
+from array import array
+from datetime import datetime, timezone
+
+import peewee
+
+from .model import VMSeries
+
+HOUR = VMSeries.HOUR
+SERIES_QUERIES = {
+    # CPU seconds used in the hour
+    "cpu": "(sum by (name) (increase(container_cpu_usage_seconds_total{%s}[1h])))[%s:1h]",
+    # memory peak in the hour
+    "memory": "(sum by (name) (max_over_time(container_memory_max_usage_bytes{%s}[1h])))[%s:1h]",
+    # bytes transferred in the hour
+    "network_inbound": "(sum by (name) (increase(container_network_receive_bytes_total{%s}[1h])))[%s:1h]",
+    "network_outbound": "(sum by (name) (increase(container_network_transmit_bytes_total{%s}[1h])))[%s:1h]",
+}
+
+
+def get_samples(values):
+    """Convert matrix values into hourly samples.
+
+    Returns tuple (start, array), where start is the epoch timestamp of the
+    first hour. The value evaluated at time T belongs to the hour ending at T.
+    """
+    times = [int(float(v[0])) // HOUR * HOUR for v in values]
+    start = times[0] - HOUR
+    samples = array("d", bytes(8 * ((times[-1] - start) // HOUR)))
+    for t, v in zip(times, values):
+        samples[(t - start) // HOUR - 1] = float(v[1])
+    return start, samples
+
+
+def query_series(prom, data, flt, rng):
+    """Query hourly samples for the known pods.
+
+    Returns dictionary {uid: {metric: (start, array)}}.
+    """
+    series = {}
+    for metric, query in SERIES_QUERIES.items():
+        data["query"] = query % (flt, rng)
+        response = prom.query(data)
+        for item in response["data"]["result"]:
+            # dirty hack: parse POD uid from "name" label
+            if "name" not in item["metric"] or not item.get("values"):
+                continue
+            uid = item["metric"]["name"].split("_")[-2]
+            if uid not in prom.pods:
+                continue
+            series.setdefault(uid, {})[metric] = get_samples(item["values"])
+    logging.debug("Hourly series for %d pods", len(series))
+    return series
+
+
+def merge_series(row, new):
+    """Merge new samples {metric: (start, array)} into the VMSeries row."""
+    starts = [start for start, _ in new.values()]
+    ends = [start + len(samples) * HOUR for start, samples in new.values()]
+    if row.start_time is not None:
+        starts.append(int(row.start_time.timestamp()))
+        ends.append(int(row.end_time.timestamp()))
+    start, end = min(starts), max(ends)
+    for metric in VMSeries.METRICS:
+        merged = array("d", bytes(8 * ((end - start) // HOUR)))
+        if row.start_time is not None:
+            offset = (int(row.start_time.timestamp()) - start) // HOUR
+            old = row.get_array(metric)
+            offset_end = offset + len(old)
+            merged[offset:offset_end] = old
+        if metric in new:
+            new_start, samples = new[metric]
+            offset = (new_start - start) // HOUR
+            offset_end = offset + len(samples)
+            merged[offset:offset_end] = samples
+        setattr(row, metric, VMSeries.pack(merged))
+    row.start_time = datetime.fromtimestamp(start, timezone.utc)
+    row.end_time = datetime.fromtimestamp(end, timezone.utc)
+    return row
+
+
+def save_series(series):
+    """Merge the hourly samples into the stored series."""
+    rows = {}
+    for uids in peewee.chunked(series.keys(), 500):
+        for row in VMSeries.select().where(VMSeries.local_id.in_(uids)):
+            rows[str(row.local_id)] = row
+    with VMSeries._meta.database.atomic():
+        for uid, new in series.items():
+            row = rows.get(uid)
+            if row is None:
+                row = merge_series(VMSeries(local_id=uid), new)
+                row.save(force_insert=True)
+            else:
+                merge_series(row, new).save()
+
+
+def sum_buckets(row, metric, stamps, totals):
+    """Add samples of the metric into the buckets.
+
+    The hourly sample is accounted into the bucket containing its start.
+
+    :param stamps: sorted epoch timestamps of the bucket edges
+    :param totals: list of the bucket totals to update
+    """
+    samples = row.get_array(metric)
+    start = int(row.start_time.timestamp())
+    end = start + len(samples) * HOUR
+    first_bucket = max(0, bisect.bisect_right(stamps, start) - 1)
+    last_bucket = min(len(stamps) - 1, bisect.bisect_left(stamps, end))
+    for i in range(first_bucket, last_bucket):
+        first = max(0, -((start - stamps[i]) // HOUR))
+        last = min(len(samples), -((start - stamps[i + 1]) // HOUR))
+        if first < last:
+            totals[i] += sum(samples[first:last])
+    return totals
@@ -0,0 +1,223 @@
+"""APEL spool dir with size accounting and backpressure
+
+The harvester adds one APEL message per run into the spool dir (dirq
+QueueSimple), SSM sender removes the messages after sending. If the sender
+is not able to send the messages for a longer time, the spool dir grows and
+it can fill the shared volume.
+
+The spool keeps track of the number of queued messages and their size. When
+any configured limit would be exceeded, the backpressure policy is applied:
+
+* merge: merge all queued messages and the new one into a single message,
+  keeping only the newest record of each pod
+* drop: drop the queued records superseded by the new message
+* refuse: do not add the new message
+
+The new message is refused, if the limits are still exceeded after merging or
+dropping.
+
+Configuration:
+[default]
+apel_spool=<spool dir>
+# limits (0 means unlimited), size suffixes K, M, G are accepted
+apel_spool_max_messages=0
+apel_spool_max_size=0
+apel_spool_policy=merge
+# Prometheus textfile with the spool metrics
+apel_spool_metrics=<file>
+"""
+
+import logging
+import os
+
+from dirq import QueueSimple
+
+HEADER = "APEL-cloud-message: v0.4\n"
+SEPARATOR = "\n%%\n"
+UUID_KEY = "VMUUID: "
+POLICY_MERGE = "merge"
+POLICY_DROP = "drop"
+POLICY_REFUSE = "refuse"
+POLICIES = [POLICY_MERGE, POLICY_DROP, POLICY_REFUSE]
+DEFAULT_POLICY = POLICY_MERGE
+# maximal age of the temporary and locked elements (in seconds)
+MAX_TEMP = 300
+MAX_LOCK = 600
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+METRICS_PREFIX = "egi_notebooks_accounting_spool"
+
+
+def parse_size(value):
+    """Parse size in bytes with optional K, M, or G suffix."""
+    value = str(value).strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value or 0)
+
+
+def format_message(records):
+    return HEADER + SEPARATOR.join(records)
+
+
+def parse_message(message):
+    """Split the APEL message into the records.
+
+    Returns dictionary {uid: record}.
+    """
+    records = {}
+    body = message.removeprefix(HEADER)
+    for record in body.split(SEPARATOR):
+        if not record:
+            continue
+        uid = None
+        for line in record.splitlines():
+            if line.startswith(UUID_KEY):
+                uid = line.removeprefix(UUID_KEY)
+                break
+        records[uid] = record
+    return records
+
+
+class Spool:
+    def __init__(
+        self,
+        path,
+        max_messages=0,
+        max_size=0,
+        policy=DEFAULT_POLICY,
+        metrics_file=None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown spool policy '{policy}'")
+        self.queue = QueueSimple.QueueSimple(path)
+        self.max_messages = max_messages
+        self.max_size = max_size
+        self.policy = policy
+        self.metrics_file = metrics_file
+        self.refused = 0
+
+    def stats(self):
+        """Number of the queued messages and their size in bytes."""
+        count = 0
+        size = 0
+        for name in self.queue:
+            try:
+                size += os.path.getsize(os.path.join(self.queue.path, name))
+                count += 1
+            except OSError:
+                # removed in the meantime
+                pass
+        return count, size
+
+    def over_limits(self, count, size):
+        return bool(
+            (self.max_messages and count > self.max_messages)
+            or (self.max_size and size > self.max_size)
+        )
+
+    def locked_messages(self):
+        """Lock and read all queued messages.
+
+        Returns list of (name, records) tuples.
+        """
+        messages = []
+        for name in self.queue:
+            if self.queue.lock(name):
+                message = self.queue.get(name).decode("utf-8")
+                messages.append((name, parse_message(message)))
+        return messages
+
+    def merge(self, records):
+        """Merge queued messages and the new records into one message.
+
+        Returns True if the merged message has been queued.
+        """
+        messages = self.locked_messages()
+        merged = {}
+        for _, old_records in messages:
+            merged.update(old_records)
+        merged.update(records)
+        message = format_message(merged.values())
+        if self.over_limits(1, len(message.encode("utf-8"))):
+            for name, _ in messages:
+                self.queue.unlock(name)
+            return False
+        self.queue.add(message)
+        for name, _ in messages:
+            self.queue.remove(name)
+        logging.info(
+            "Merged %d queued messages into one with %d records",
+            len(messages),
+            len(merged),
+        )
+        return True
+
+    def drop(self, uids):
+        """Drop the queued records of the given pods."""
+        dropped = 0
+        for name, old_records in self.locked_messages():
+            kept = [r for uid, r in old_records.items() if uid not in uids]
+            if len(kept) == len(old_records):
+                self.queue.unlock(name)
+                continue
+            if kept:
+                self.queue.add(format_message(kept))
+            self.queue.remove(name)
+            dropped += len(old_records) - len(kept)
+        logging.info("Dropped %d superseded records", dropped)
+
+    def add(self, records):
+        """Queue the records {uid: record} as a new message.
+
+        Returns True if the records have been queued.
+        """
+        self.queue.purge(maxtemp=MAX_TEMP, maxlock=MAX_LOCK)
+        message = format_message(records.values())
+        size = len(message.encode("utf-8"))
+        count, queued_size = self.stats()
+        added = True
+        if self.over_limits(count + 1, queued_size + size):
+            logging.warning(
+                "Spool limits exceeded (%d messages, %d bytes), policy %s",
+                count,
+                queued_size,
+                self.policy,
+            )
+            if self.policy == POLICY_MERGE:
+                added = self.merge(records)
+            else:
+                if self.policy == POLICY_DROP:
+                    self.drop(records.keys())
+                    count, queued_size = self.stats()
+                if self.over_limits(count + 1, queued_size + size):
+                    added = False
+                else:
+                    self.queue.add(message)
+        else:
+            self.queue.add(message)
+        if not added:
+            self.refused += len(records)
+            logging.error("Spool full, %d records refused", len(records))
+        self.write_metrics()
+        return added
+
+    def write_metrics(self):
+        """Write the spool metrics in Prometheus text format."""
+        count, size = self.stats()
+        logging.debug("Spool: %d messages, %d bytes", count, size)
+        if not self.metrics_file:
+            return
+        metrics = [
+            ("messages", "Number of the queued APEL messages", count),
+            ("bytes", "Size of the queued APEL messages", size),
+            ("refused_records", "Records refused in the last run", self.refused),
+        ]
+        lines = []
+        for name, description, value in metrics:
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+            lines.append(f"{METRICS_PREFIX}_{name} {value}")
+        tmp_file = self.metrics_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.metrics_file)
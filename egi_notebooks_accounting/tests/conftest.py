@@ -1,14 +1,21 @@
 import logging
+import re
 import uuid
 from configparser import ConfigParser
 from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import parse_qs
 
 import pytest
 
-from ..model import VM, db_init
+from ..model import VM, VMChange, VMSeries, db_init
+from ..remote_read import STREAMED_CONTENT_TYPE, parse_matchers, snappy_decompress
+from .remote_read_server import decode_read_request, encode_frame, encode_xor_chunk
 
 CONFIG_FILE_NAME: str = "config-tests.ini"
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600}
+# Prometheus lookback delta (in seconds)
+LOOKBACK = 300
 
 
 def pytest_configure(config):
@@ -44,6 +51,8 @@ def db(pytestconfig):
 def truncate(db):
     """Cleanup the data before testing."""
     VM.truncate_table()
+    VMSeries.truncate_table()
+    VMChange.truncate_table()
 
 
 class TestHelpers:
@@ -90,3 +99,215 @@ class TestHelpers:
             flavor=TestHelpers.flavor_name,
             cpu_duration=0.1 * wall,
         )
+
+
+class FakePrometheus:
+    """
+    Mock of Prometheus query and remote read API with kube-state-metrics and
+    cadvisor metrics of testing pods.
+    """
+
+    URL = "http://localhost:8080/api/v1/query"
+    READ_URL = "http://localhost:8080/api/v1/read"
+    # samples per XOR chunk
+    CHUNK_SAMPLES = 50
+    NAMESPACE = "testsuite"
+    IMAGE = "notebook:latest"
+
+    def __init__(self, requests_mock):
+        self.pods = []
+        self.queries = []
+        self.reads = []
+        requests_mock.post(FakePrometheus.URL, json=self.respond)
+        requests_mock.post(
+            FakePrometheus.READ_URL,
+            content=self.read,
+            headers={
+                "Content-Type": STREAMED_CONTENT_TYPE
+                + "; proto=prometheus.ChunkedReadResponse"
+            },
+        )
+
+    def pod(
+        self,
+        i: int,
+        created: int,
+        phases: str,
+        step: int = 30,
+        cpu: float = 0,
+        flavor: str | None = None,
+        offset: int = 0,
+    ) -> str:
+        """
+        Add testing pod.
+
+        :param i:
+            Number (index) of the testing pod.
+
+        :param created:
+            Creation time (epoch).
+
+        :param phases:
+            Running phase values since creation, for example "0111100".
+
+        :param step:
+            Scrape interval.
+
+        :param cpu:
+            CPU usage in seconds.
+
+        :param flavor:
+            Flavor annotation (the testing flavor by default).
+
+        :param offset:
+            Offset of the scrapes after the creation time.
+        """
+        uid = str(uuid.UUID(int=i))
+        self.pods.append(
+            {
+                "uid": uid,
+                "pod": f"jupyter-user{i}",
+                "created": created,
+                "phases": [
+                    [created + offset + j * step, phase]
+                    for j, phase in enumerate(phases)
+                ],
+                "cpu": cpu,
+                "flavor": flavor or TestHelpers.flavor_name,
+            }
+        )
+        return uid
+
+    def labels(self, pod: dict) -> dict:
+        return {
+            "namespace": FakePrometheus.NAMESPACE,
+            "pod": pod["pod"],
+            "uid": pod["uid"],
+        }
+
+    def matches(self, pod: dict, matchers: list) -> bool:
+        """Check the pod, namespace, and uid label matchers."""
+        labels = self.labels(pod)
+        for name, op, value in matchers:
+            if name not in labels:
+                continue
+            if op in ["=", "!="]:
+                matched = labels[name] == value
+            else:
+                matched = re.fullmatch(value, labels[name]) is not None
+            if matched != (op in ["=", "=~"]):
+                return False
+        return True
+
+    def series(self, query: str, pod: dict, now: float) -> dict | None:
+        """Result series of the pod for the query."""
+        for selector in re.findall(r"\{([^}]*)\}", query):
+            if not self.matches(pod, parse_matchers(selector)):
+                return None
+        if "count by (namespace)" in query:
+            return {
+                "metric": {"namespace": FakePrometheus.NAMESPACE},
+                "value": [now, "1"],
+            }
+        if "kube_pod_created" in query:
+            return {"metric": self.labels(pod), "value": [now, str(pod["created"])]}
+        if "kube_pod_status_phase" in query:
+            if "timestamp(" in query:
+                return self.running_timestamp(query, pod, now)
+            if "last_over_time" in query:
+                return {"metric": self.labels(pod), "value": [now, "0"]}
+            return {"metric": self.labels(pod), "values": pod["phases"]}
+        if "kube_pod_annotations" in query:
+            metric = self.labels(pod)
+            metric["annotation_hub_jupyter_org_username"] = TestHelpers.USER
+            metric["annotation_egi_eu_primary_group"] = TestHelpers.FQAN
+            metric["annotation_egi_eu_flavor"] = pod["flavor"]
+            return {"metric": metric, "value": [now, "1"]}
+        if "kube_pod_container_info" in query:
+            metric = self.labels(pod)
+            metric["image"] = FakePrometheus.IMAGE
+            return {"metric": metric, "value": [now, "1"]}
+        if "kube_pod_container_resource_requests" in query:
+            return {"metric": {"uid": pod["uid"]}, "value": [now, "1"]}
+        if "container_cpu_usage_seconds_total" in query and ":1h]" not in query:
+            name = (
+                f"k8s_notebook_{pod['pod']}_{FakePrometheus.NAMESPACE}_{pod['uid']}_0"
+            )
+            return {"metric": {"name": name}, "value": [now, str(pod["cpu"])]}
+        return None
+
+    def running_timestamp(self, query: str, pod: dict, now: float) -> dict | None:
+        """
+        Evaluate timestamp() of the last running sample like Prometheus.
+
+        timestamp() of a selector is the sample time, timestamp() of an
+        expression is the evaluation time (the subquery steps).
+        """
+        bare = re.search(r"timestamp\(kube_pod_status_phase\{[^}]*\}\)", query)
+        subquery = re.search(r"\[(\d+)([smh]):(\d+)([smh])\]", query)
+        if subquery:
+            rng = int(subquery.group(1)) * DURATION_UNITS[subquery.group(2)]
+            step = int(subquery.group(3)) * DURATION_UNITS[subquery.group(4)]
+            last = int(now) // step * step
+            times = range(last, int(now) - rng, -step)
+        else:
+            times = [now]
+        for t in times:
+            samples = [(ts, v) for ts, v in pod["phases"] if t - LOOKBACK < ts <= t]
+            if samples and samples[-1][1] == "1":
+                value = samples[-1][0] if bare else t
+                return {"metric": self.labels(pod), "value": [now, str(value)]}
+        return None
+
+    def respond(self, request, context) -> dict:
+        form = parse_qs(request.text)
+        query = form["query"][0]
+        now = float(form["time"][0])
+        self.queries.append(query)
+        result = []
+        labels = set()
+        # "or" queries (the parts tagged by label_replace() in merged queries)
+        for part in query.split(" or "):
+            tag = re.search(r'label_replace\(.*, "(\w+)", "(\w+)", "", ""\)$', part)
+            for pod in self.pods:
+                item = self.series(part, pod, now)
+                if item is not None:
+                    if tag:
+                        item["metric"][tag.group(1)] = tag.group(2)
+                    key = frozenset(item["metric"].items())
+                    if key not in labels:
+                        labels.add(key)
+                        result.append(item)
+        result_type = "matrix" if result and "values" in result[0] else "vector"
+        return {
+            "status": "success",
+            "data": {"resultType": result_type, "result": result},
+        }
+
+    def read(self, request, context) -> bytes:
+        """Streamed remote read response with kube_pod_status_phase samples."""
+        assert request.headers["Content-Encoding"] == "snappy"
+        queries, _ = decode_read_request(snappy_decompress(request.body))
+        self.reads.append(queries)
+        frames = []
+        for query_index, (matchers, start_ms, end_ms) in enumerate(queries):
+            for pod in self.pods:
+                if not self.matches(pod, matchers):
+                    continue
+                samples = [
+                    (t * 1000, float(v))
+                    for t, v in pod["phases"]
+                    if start_ms <= t * 1000 <= end_ms
+                ]
+                size = FakePrometheus.CHUNK_SAMPLES
+                chunks = []
+                while samples:
+                    chunk, samples = samples[:size], samples[size:]
+                    chunks.append((chunk[0][0], chunk[-1][0], encode_xor_chunk(chunk)))
+                labels = self.labels(pod)
+                labels["__name__"] = "kube_pod_status_phase"
+                labels["phase"] = "Running"
+                # each chunk in a separate frame
+                for chunk in chunks:
+                    frames.append(encode_frame([(labels, [chunk])], query_index))
+        return b"".join(frames)
@@ -0,0 +1,175 @@
+"""Server side of the Prometheus remote read protocol for the tests
+
+Encoding of the XOR chunks and streamed response frames, decoding of the
+read requests. Only used by the fake Prometheus, the client side is in
+egi_notebooks_accounting.remote_read.
+"""
+
+import struct
+
+from ..remote_read import (
+    CHUNK_XOR,
+    MATCHER_TYPES,
+    decode_varint,
+    encode_field,
+    encode_varint,
+    iter_fields,
+    to_int64,
+)
+
+
+def encode_label(name, value):
+    return encode_field(1, name) + encode_field(2, value)
+
+
+def decode_read_request(data):
+    """Decode prometheus.ReadRequest.
+
+    Returns list of (matchers, start_ms, end_ms) tuples and the accepted
+    response types.
+    """
+    operators = {v: k for k, v in MATCHER_TYPES.items()}
+    queries = []
+    accepted = []
+    for number, field in iter_fields(data):
+        if number == 1:
+            matchers = []
+            start_ms = end_ms = 0
+            for qnumber, qfield in iter_fields(field):
+                if qnumber == 1:
+                    start_ms = to_int64(qfield)
+                elif qnumber == 2:
+                    end_ms = to_int64(qfield)
+                elif qnumber == 3:
+                    m = dict(iter_fields(qfield))
+                    matchers.append(
+                        (
+                            str(m.get(2, b""), "utf-8"),
+                            operators[m.get(1, 0)],
+                            str(m.get(3, b""), "utf-8"),
+                        )
+                    )
+            queries.append((matchers, start_ms, end_ms))
+        elif number == 2:
+            if isinstance(field, int):
+                accepted.append(field)
+            else:
+                pos = 0
+                while pos < len(field):
+                    value, pos = decode_varint(field, pos)
+                    accepted.append(value)
+    return queries, accepted
+
+
+class BitWriter:
+    def __init__(self):
+        self.value = 0
+        self.size = 0
+
+    def write(self, value, n):
+        self.value = (self.value << n) | (value & ((1 << n) - 1))
+        self.size += n
+
+    def write_uvarint(self, value):
+        for b in encode_varint(value):
+            self.write(b, 8)
+
+    def write_varint(self, value):
+        self.write_uvarint((value << 1) ^ (value >> 63))
+
+    def bytes(self):
+        pad = -self.size % 8
+        return (self.value << pad).to_bytes((self.size + pad) // 8, "big")
+
+
+# delta-of-delta buckets: (prefix, prefix bits, value bits)
+DOD_BUCKETS = [(0b10, 2, 14), (0b110, 3, 17), (0b1110, 4, 20)]
+
+
+def encode_xor_chunk(samples):
+    """Encode list of (timestamp ms, value) into XOR chunk."""
+    writer = BitWriter()
+    prev_t = prev_delta = prev_bits = 0
+    leading = trailing = None
+    for i, (t, v) in enumerate(samples):
+        bits = int.from_bytes(struct.pack(">d", v), "big")
+        if i == 0:
+            writer.write_varint(t)
+            writer.write(bits, 64)
+        else:
+            delta = t - prev_t
+            if i == 1:
+                writer.write_uvarint(delta)
+            else:
+                dod = delta - prev_delta
+                if dod == 0:
+                    writer.write(0, 1)
+                else:
+                    for prefix, prefix_size, size in DOD_BUCKETS:
+                        if -((1 << (size - 1)) - 1) <= dod <= 1 << (size - 1):
+                            writer.write(prefix, prefix_size)
+                            writer.write(dod, size)
+                            break
+                    else:
+                        writer.write(0b1111, 4)
+                        writer.write(dod, 64)
+            prev_delta = delta
+            xor = bits ^ prev_bits
+            if xor == 0:
+                writer.write(0, 1)
+            else:
+                writer.write(1, 1)
+                lead = min(64 - xor.bit_length(), 31)
+                trail = (xor & -xor).bit_length() - 1
+                if leading is not None and lead >= leading and trail >= trailing:
+                    writer.write(0, 1)
+                    writer.write(xor >> trailing, 64 - leading - trailing)
+                else:
+                    leading, trailing = lead, trail
+                    significant = 64 - leading - trailing
+                    writer.write(1, 1)
+                    writer.write(leading, 5)
+                    writer.write(significant, 6)
+                    writer.write(xor >> trailing, significant)
+        prev_t, prev_bits = t, bits
+    return struct.pack(">H", len(samples)) + writer.bytes()
+
+
+CRC32C_TABLE = []
+for _n in range(256):
+    _c = _n
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0x82F63B78 if _c & 1 else _c >> 1
+    CRC32C_TABLE.append(_c)
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = CRC32C_TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def encode_frame(series, query_index=0):
+    """Encode one frame of the streamed response.
+
+    :param series: list of (labels, list of XOR chunks (min ms, max ms, data))
+    """
+    message = b""
+    for labels, chunks in series:
+        data = b"".join(
+            encode_field(1, encode_label(name, value))
+            for name, value in sorted(labels.items())
+        )
+        for min_time, max_time, chunk in chunks:
+            data += encode_field(
+                2,
+                encode_field(1, min_time)
+                + encode_field(2, max_time)
+                + encode_field(3, CHUNK_XOR)
+                + encode_field(4, chunk),
+            )
+        message += encode_field(1, data)
+    if query_index:
+        message += encode_field(2, query_index)
+    return encode_varint(len(message)) + struct.pack(">I", crc32c(message)) + message
@@ -0,0 +1,46 @@
+import csv
+import logging
+
+import dateutil.parser
+from freezegun import freeze_time
+
+from .. import archive, report
+from ..model import MODELS, VM, VMSeries, archive_db_init
+from ..series import get_samples, save_series
+from .conftest import TestHelpers
+
+
+def test_archive(pytestconfig, tmp_path) -> None:
+    """Old completed pods are moved to the archive, still reachable by reports."""
+    archive_file = tmp_path / "archive.db"
+    pod = TestHelpers.pod(1, dateutil.parser.parse("2025-01-10T10:00:00Z"), 3600)
+    save_series({str(pod.local_id): {"cpu": get_samples([[1736506800, "60"]])}})
+    TestHelpers.pod(2, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600)
+    # still running
+    TestHelpers.pod(3, dateutil.parser.parse("2025-01-10T10:00:00Z"), None)
+
+    args = ["-c", str(pytestconfig.config_file), "--archive-db", str(archive_file)]
+    args += ["--retention", "30"]
+    logging.info(
+        f"Command: python -m egi_notebooks_accounting.archive {' '.join(args)}"
+    )
+    with freeze_time("2026-03-01T00:00:00Z"):
+        assert archive.main(args) == 0, "archive finished successfully"
+
+    assert VM.select().count() == 2, "two records left in the main db"
+    assert VM.get_or_none(VM.machine == "machine1") is None, "old pod archived"
+    archive_db = archive_db_init(str(archive_file))
+    assert VMSeries.select().count() == 0, "series archived"
+    with archive_db.bind_ctx(MODELS):
+        assert [pod.machine for pod in VM.select()] == ["machine1"]
+        assert list(VMSeries.get().get_array("cpu")) == [60.0]
+
+    output = tmp_path / "report.csv"
+    report_args = ["-c", str(pytestconfig.config_file), "-o", str(output)]
+    report_args += ["--from-date", "2025-01-10", "--to-date", "2025-01-11"]
+    report_args += ["--group-by", "namespace"]
+    assert report.main(report_args + ["--archive-db", str(archive_file)]) == 0
+    rows = list(csv.DictReader(output.read_text().splitlines()))
+    assert len(rows) == 1
+    assert rows[0]["pods"] == "2", "archived and running pod"
+    assert float(rows[0]["hours"]) == 15.0
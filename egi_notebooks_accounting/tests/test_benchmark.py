@@ -0,0 +1,355 @@
+"""
+Performance benchmarks of the EOSC aggregation and of the pod status decoding.
+
+Skipped by default, launch with the number of the synthetic pods:
+
+    BENCHMARK_PODS=100000 pytest -v -s egi_notebooks_accounting/tests/test_benchmark.py
+
+Environment:
+
+* BENCHMARK_PODS: number of the synthetic pods (100k - 10M)
+* BENCHMARK_DAYS: days of history (90)
+* BENCHMARK_REPORT_DAYS: days in the multi-day reports (7)
+* BENCHMARK_SERIES: number of the pod status series (1000)
+* BENCHMARK_RESULTS: JSON file to store the measured results
+* BENCHMARK_THRESHOLDS: JSON file with the thresholds (benchmark-thresholds.json)
+
+Thresholds are seconds and peak memory (MiB) per 1000 pods overlapping the
+reported window. The size of the history does not matter, the reports should
+not scan the pods outside of the window.
+
+The status decoding compares the remote read (XOR chunks) with the JSON range
+query of the same kube_pod_status_phase samples (24 hours, 30 s scrapes).
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from .. import eosc
+from ..model import VM, archive_db_init, db_init
+from ..pods import get_last_running
+from ..remote_read import SeriesSet, iter_frames
+from .remote_read_server import encode_frame, encode_xor_chunk
+
+PODS = int(os.environ.get("BENCHMARK_PODS", 0))
+DAYS = int(os.environ.get("BENCHMARK_DAYS", 90))
+REPORT_DAYS = int(os.environ.get("BENCHMARK_REPORT_DAYS", 7))
+SERIES = int(os.environ.get("BENCHMARK_SERIES", 1000))
+RESULTS_FILE = os.environ.get("BENCHMARK_RESULTS")
+THRESHOLDS_FILE = os.environ.get(
+    "BENCHMARK_THRESHOLDS", Path(__file__).parent / "benchmark-thresholds.json"
+)
+# 2026-02-27T00:00:00Z
+END = datetime(2026, 2, 27, tzinfo=timezone.utc)
+USERS = 1000
+GROUPS = 20
+# share of the pods still running
+RUNNING = 0.01
+BATCH = 10000
+# status samples: scrape interval (ms), samples in the query range, chunk size
+SCRAPE = 30000
+SAMPLES = 2880
+CHUNK_SAMPLES = 120
+COLUMNS = [
+    "local_id",
+    "namespace",
+    "machine",
+    "global_user_name",
+    "fqan",
+    "status",
+    "start_time",
+    "end_time",
+    "wall",
+    "cpu_duration",
+    "cpu_count",
+    "flavor",
+]
+
+pytestmark = pytest.mark.skipif(not PODS, reason="BENCHMARK_PODS not set")
+
+results = {}
+
+
+def synthetic_pods(count: int, flavors: list[str]):
+    """Pods uniformly distributed over the history, mostly short-lived."""
+    rnd = random.Random(42)
+    end = int(END.timestamp())
+    start = end - DAYS * 86400
+    # unknown flavor is not reported
+    flavors = flavors + ["unknown"]
+    for i in range(count):
+        wall = min(int(rnd.expovariate(1 / (4 * 3600))), 7 * 86400)
+        start_time = rnd.randrange(start, end - wall)
+        running = rnd.random() < RUNNING
+        user = rnd.randrange(USERS)
+        yield (
+            uuid.UUID(int=i + 1).hex,
+            "benchmark",
+            f"jupyter-user{user}",
+            f"user{user}@example.com",
+            f"group{user % GROUPS}",
+            "started" if running else "completed",
+            start_time,
+            None if running else start_time + wall,
+            wall,
+            0.1 * wall,
+            1,
+            flavors[i % len(flavors)],
+        )
+
+
+@pytest.fixture(scope="module")
+def benchmark_db(pytestconfig, tmp_path_factory) -> str:
+    """Database with the synthetic pods (not bound to the models)."""
+    db_file = str(tmp_path_factory.mktemp("benchmark") / "notebooks.db")
+    database = archive_db_init(db_file)
+    pods = synthetic_pods(PODS, list(pytestconfig.flavor_config.keys()))
+    columns = ", ".join(COLUMNS)
+    params = ", ".join("?" * len(COLUMNS))
+    sql = f"INSERT INTO {VM._meta.table_name} ({columns}) VALUES ({params})"
+    t = time.perf_counter()
+    with database.connection_context():
+        with database.atomic():
+            batch = True
+            while batch:
+                batch = [row for _, row in zip(range(BATCH), pods)]
+                database.cursor().executemany(sql, batch)
+    logging.info(f"Generated {PODS} pods in {time.perf_counter() - t:.1f} s")
+    return db_file
+
+
+@pytest.fixture(scope="module", autouse=True)
+def results_file():
+    yield
+    write_results()
+
+
+@pytest.fixture(scope="function")
+def bound_db(pytestconfig, benchmark_db) -> str:
+    """Bind the models to the benchmark database during the test."""
+    db_init(benchmark_db)
+    yield benchmark_db
+    db_init(pytestconfig.db_file)
+
+
+class Endpoint(BaseHTTPRequestHandler):
+    """Local mock of the AAI token and EOSC accounting endpoints."""
+
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        Endpoint.requests += 1
+        body = json.dumps({"access_token": "token-of-accounting"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def endpoint() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Endpoint)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="function")
+def config_file(pytestconfig, bound_db, endpoint, tmp_path) -> str:
+    """Configuration with the benchmark database and the local endpoint."""
+    config = tmp_path / "config.ini"
+    flavors = "\n".join(f"{k}={v}" for k, v in pytestconfig.flavor_config.items())
+    config.write_text(f"""[default]
+notebooks_db={bound_db}
+
+[eosc]
+token_url={endpoint}/token
+accounting_url={endpoint}
+installation_id=benchmark
+timestamp_file={tmp_path / "eosc.timestamp"}
+
+[eosc.flavors]
+{flavors}
+""")
+    return str(config)
+
+
+def measure(name: str, func) -> dict:
+    """Measure the time and (in a separate run) the peak memory."""
+    logging.disable(logging.DEBUG)
+    try:
+        t = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - t
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        logging.disable(logging.NOTSET)
+    result = {"pods": PODS, "seconds": seconds, "peak_mib": peak / 1024**2}
+    results[name] = result
+    logging.info(f"{name}: {result}")
+    return result
+
+
+def window_pods(days: int) -> int:
+    """Number of the pods overlapping the reported window."""
+    start = END - timedelta(days=days)
+    return (
+        VM.select()
+        .where((VM.start_time < END) & (VM.end_time.is_null() | (VM.end_time >= start)))
+        .count()
+    )
+
+
+def check_thresholds(name: str, result: dict, days: int = 1) -> None:
+    with open(THRESHOLDS_FILE) as f:
+        thresholds = json.load(f).get(name, {})
+    result["window_pods"] = window_pods(days)
+    scale = result["window_pods"] / 1000
+    for key, limit in thresholds.items():
+        limit *= scale
+        assert (
+            result[key] <= limit
+        ), f"{name}: {key} {result[key]:.2f} over threshold {limit:.2f}"
+
+
+def write_results() -> None:
+    if RESULTS_FILE and results:
+        with open(RESULTS_FILE, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def report_args(config_file: str, days: int) -> list[str]:
+    start = END - timedelta(days=days)
+    args = ["-c", config_file, "--from-date", start.isoformat()]
+    return args + ["--to-date", END.isoformat()]
+
+
+def test_day_metrics(pytestconfig, bound_db) -> None:
+    """Single day aggregation."""
+    start = END - timedelta(days=1)
+    result = measure(
+        "day_metrics",
+        lambda: eosc.generate_day_metrics(
+            start, END, None, None, pytestconfig.flavor_config, None, None, True
+        ),
+    )
+    check_thresholds("day_metrics", result)
+
+
+@pytest.mark.parametrize("days", [1, REPORT_DAYS])
+def test_dry_run(config_file, days) -> None:
+    name = f"dry_run_{days}d"
+    args = report_args(config_file, days) + ["--dry-run"]
+    result = measure(name, lambda: eosc.main(args))
+    check_thresholds("dry_run", result, days)
+
+
+@pytest.mark.parametrize("days", [1, REPORT_DAYS])
+def test_push(config_file, days) -> None:
+    name = f"push_{days}d"
+    Endpoint.requests = 0
+    result = measure(name, lambda: eosc.main(report_args(config_file, days)))
+    assert Endpoint.requests > 2 * days, "token and metrics pushed"
+    result["requests"] = Endpoint.requests // 2
+    check_thresholds("push", result, days)
+
+
+def status_series(jitter: int):
+    """Pod status series, pods are deleted a few scrapes after stopping.
+
+    :param jitter: maximal deviation of the scrape timestamps (ms)
+    """
+    rnd = random.Random(42)
+    end = int(END.timestamp() * 1000)
+    start = end - SAMPLES * SCRAPE
+    for i in range(SERIES):
+        labels = {
+            "__name__": "kube_pod_status_phase",
+            "namespace": "jupyter",
+            "pod": f"jupyter-user{i}",
+            "uid": str(uuid.UUID(int=i + 1)),
+            "phase": "Running",
+        }
+        running = rnd.random() < 0.5
+        stop = SAMPLES if running else rnd.randrange(1, SAMPLES - 10)
+        samples = [
+            (start + k * SCRAPE + rnd.randint(-jitter, jitter), float(k < stop))
+            for k in range(min(stop + 10, SAMPLES))
+        ]
+        yield labels, samples
+
+
+def json_response(series: list) -> bytes:
+    """JSON range query response as produced by Prometheus."""
+    result = [
+        {"metric": labels, "values": [[t / 1000, f"{v:g}"] for t, v in samples]}
+        for labels, samples in series
+    ]
+    data = {"status": "success", "data": {"resultType": "matrix", "result": result}}
+    return json.dumps(data).encode()
+
+
+def remote_read_response(series: list) -> bytes:
+    """Streamed remote read response, a frame per series."""
+    frames = []
+    for labels, samples in series:
+        chunks = []
+        for start in range(0, len(samples), CHUNK_SAMPLES):
+            end = start + CHUNK_SAMPLES
+            chunk = samples[start:end]
+            chunks.append((chunk[0][0], chunk[-1][0], encode_xor_chunk(chunk)))
+        frames.append(encode_frame([(labels, chunks)]))
+    return b"".join(frames)
+
+
+@pytest.mark.parametrize("jitter", [0, 5])
+def test_status_decoding(jitter) -> None:
+    """Remote read costs less CPU than the JSON range query."""
+    series = list(status_series(jitter))
+    json_body = json_response(series)
+    read_body = remote_read_response(series)
+
+    t = time.perf_counter()
+    result = json.loads(str(json_body, "utf-8"))["data"]["result"]
+    json_last = [get_last_running(item["values"]) for item in result]
+    json_seconds = time.perf_counter() - t
+
+    t = time.perf_counter()
+    series_set = SeriesSet()
+    for message in iter_frames([read_body]):
+        series_set.add_chunked(message)
+    read_last = [last for _, last in series_set.last_times()]
+    read_seconds = time.perf_counter() - t
+
+    assert read_last == [int(t) if t else None for t in json_last]
+    result = {
+        "series": SERIES,
+        "json_seconds": json_seconds,
+        "json_mib": len(json_body) / 1024**2,
+        "remote_read_seconds": read_seconds,
+        "remote_read_mib": len(read_body) / 1024**2,
+    }
+    results[f"status_jitter_{jitter}ms"] = result
+    logging.info(f"status decoding (jitter {jitter} ms): {result}")
+    assert read_seconds < json_seconds
@@ -1,5 +1,5 @@
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import dateutil.parser
@@ -8,6 +8,7 @@ from freezegun import freeze_time
 
 from .. import eosc
 from ..model import VM
+from ..pods import save_pods, set_modified
 from .conftest import TestHelpers
 
 
@@ -245,3 +246,96 @@ def test_dupla(pytestconfig, requests_mock, delete_timestamp) -> None:
         results,
         interval=timedelta(hours=12),
     )
+
+
+def test_changed(
+    pytestconfig, requests_mock, delete_timestamp, monkeypatch, tmp_path
+) -> None:
+    """Corrected end time of the pod re-reports only the affected days."""
+    changes_timestamp_file = tmp_path / "changes.timestamp"
+    changes_timestamp_file.write_text("2026-02-27T14:00:00Z")
+    monkeypatch.setenv("CHANGES_TIMESTAMP_FILE", str(changes_timestamp_file))
+    requests_mock.post(eosc.DEFAULT_TOKEN_URL, json={"access_token": "token"})
+    metrics = requests_mock.post(
+        f"{pytestconfig.eosc_config['accounting_url']}/accounting-system/installations/"
+        f"{pytestconfig.eosc_config['installation_id']}/metrics",
+        text="OK",
+    )
+    args = ["-c", str(pytestconfig.config_file), "--changed"]
+    running = pod(1, dateutil.parser.parse("2026-02-27T13:00:00Z"), None)
+    running.modified = dateutil.parser.parse("2026-02-27T13:00:00Z")
+    running.save()
+    other = pod(2, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600)
+    other.global_user_name = "other"
+    other.save()
+    with freeze_time("2026-02-28T00:10:00Z"):
+        eosc.main(args + ["--from-date", "2026-02-27T00:00:00Z"])
+    with freeze_time("2026-03-01T00:10:00Z"):
+        eosc.main(args)
+    values = sorted(
+        (r.json()["time_period_start"], r.json()["value"])
+        for r in metrics.request_history
+    )
+    assert values == [
+        ("2026-02-27T00:00:00Z", 1.0),
+        ("2026-02-27T00:00:00Z", 11.0),
+        ("2026-02-28T00:00:00Z", 24.0),
+    ], "modified before the last re-report"
+
+    metrics.reset()
+    running.end_time = dateutil.parser.parse("2026-02-27T15:00:00Z")
+    running.wall = 7200
+    running.modified = dateutil.parser.parse("2026-03-01T10:00:00Z")
+    running.save()
+    with freeze_time("2026-03-02T00:10:00Z"):
+        eosc.main(args)
+    pushed = [r.json() for r in metrics.request_history]
+    assert [(m["time_period_start"], m["value"]) for m in pushed] == [
+        ("2026-02-27T00:00:00Z", 2.0),
+        ("2026-02-28T00:00:00Z", 0),
+    ], "affected days re-reported, nothing on the next day"
+    assert {m["user_id"] for m in pushed} == {TestHelpers.USER}
+    assert changes_timestamp_file.read_text() == "2026-03-02T00:10:00Z"
+
+    metrics.reset()
+    with freeze_time("2026-03-03T00:10:00Z"):
+        eosc.main(args)
+    assert not metrics.called, "no changes"
+
+
+def test_changed_flavor(
+    pytestconfig, requests_mock, db, delete_timestamp, monkeypatch, tmp_path
+) -> None:
+    """Hours of the pod are moved from the old flavor to the new one."""
+    changes_timestamp_file = tmp_path / "changes.timestamp"
+    monkeypatch.setenv("CHANGES_TIMESTAMP_FILE", str(changes_timestamp_file))
+    requests_mock.post(eosc.DEFAULT_TOKEN_URL, json={"access_token": "token"})
+    metrics = requests_mock.post(
+        f"{pytestconfig.eosc_config['accounting_url']}/accounting-system/installations/"
+        f"{pytestconfig.eosc_config['installation_id']}/metrics",
+        text="OK",
+    )
+    args = ["-c", str(pytestconfig.config_file), "--changed"]
+    uid = str(pod(1, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600).local_id)
+    with freeze_time("2026-02-28T00:10:00Z"):
+        eosc.main(args + ["--from-date", "2026-02-27T00:00:00Z"])
+    changes_timestamp_file.write_text("2026-02-28T00:10:00Z")
+
+    # new flavor annotation harvested
+    stored = {uid: VM.get_by_id(uid)}
+    pods = {uid: VM.get_by_id(uid)}
+    pods[uid].flavor = "flavb"
+    with freeze_time("2026-02-28T10:00:00Z"):
+        set_modified(pods, stored, datetime.now(timezone.utc))
+        save_pods(db, pods, stored)
+    metrics.reset()
+    with freeze_time("2026-03-01T00:10:00Z"):
+        eosc.main(args)
+    pushed = sorted(
+        (m["time_period_start"], m["metric_definition_id"], m["value"])
+        for m in (r.json() for r in metrics.request_history)
+    )
+    assert pushed == [
+        ("2026-02-27T00:00:00Z", "id_flava", 0),
+        ("2026-02-27T00:00:00Z", "id_flavb", 1.0),
+    ], "old cell zeroed"
@@ -0,0 +1,84 @@
+import os
+from datetime import datetime, timezone
+
+import dateutil.parser
+import pytest
+from freezegun import freeze_time
+
+from .. import export
+from ..model import VM
+from .conftest import TestHelpers
+
+pyarrow = pytest.importorskip("pyarrow")
+pyarrow_dataset = pytest.importorskip("pyarrow.dataset")
+
+
+def read(export_dir, fmt="parquet"):
+    dataset = pyarrow_dataset.dataset(
+        str(export_dir), format="ipc" if fmt == "arrow" else fmt, partitioning="hive"
+    )
+    return dataset.to_table()
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "arrow"])
+def test_export(pytestconfig, tmp_path, fmt) -> None:
+    """Completed records partitioned by the end day with typed columns."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-26T22:00:00Z"), 3600)
+    TestHelpers.pod(2, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600)
+    TestHelpers.pod(3, dateutil.parser.parse("2026-02-27T10:00:00Z"), None)
+
+    args = ["-c", str(pytestconfig.config_file), "-o", str(tmp_path)]
+    assert export.main(args + ["--format", fmt]) == 0
+    assert sorted(os.listdir(tmp_path)) == [
+        "_modified",
+        "end_date=2026-02-26",
+        "end_date=2026-02-27",
+    ]
+    table = read(tmp_path, fmt)
+    assert table.num_rows == 2, "running pod not exported"
+    # parquet stores the seconds as milliseconds
+    assert pyarrow.types.is_timestamp(table.schema.field("start_time").type)
+    assert table.schema.field("start_time").type.tz == "UTC"
+    assert table.schema.field("wall").type == pyarrow.float64()
+    assert table.column("machine").to_pylist() == ["machine1", "machine2"]
+    assert table.column("local_id").to_pylist()[0] == str(VM.get().local_id)
+
+
+def test_incremental(pytestconfig, tmp_path) -> None:
+    """Only the days since the last partition are exported again."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-26T10:00:00Z"), 3600)
+    TestHelpers.pod(2, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600)
+    args = ["-c", str(pytestconfig.config_file), "-o", str(tmp_path)]
+    assert export.main(args) == 0
+
+    VM.update(wall=7200).execute()
+    TestHelpers.pod(3, dateutil.parser.parse("2026-02-27T12:00:00Z"), 3600)
+    TestHelpers.pod(4, dateutil.parser.parse("2026-02-28T10:00:00Z"), 3600)
+    assert export.export(str(tmp_path)) == 3, "last partition and the new day"
+    table = read(tmp_path).sort_by("machine")
+    assert table.column("machine").to_pylist() == [
+        "machine1",
+        "machine2",
+        "machine3",
+        "machine4",
+    ]
+    assert table.column("wall").to_pylist() == [3600, 7200, 3600, 3600]
+
+
+def test_late_record(pytestconfig, tmp_path) -> None:
+    """Records modified after the export of their day are exported again."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-27T10:00:00Z"), 3600)
+    with freeze_time("2026-02-28T00:00:00Z"):
+        assert export.export(str(tmp_path)) == 1
+    assert not os.path.exists(tmp_path / "end_date=2026-02-26")
+
+    # harvested late, or closed by the reconciliation
+    pod = TestHelpers.pod(2, dateutil.parser.parse("2026-02-26T10:00:00Z"), 3600)
+    pod.modified = datetime(2026, 2, 28, 1, tzinfo=timezone.utc)
+    pod.save()
+    with freeze_time("2026-02-28T02:00:00Z"):
+        assert export.export(str(tmp_path)) == 2, "late day and the last partition"
+    table = read(tmp_path).sort_by("machine")
+    assert table.column("machine").to_pylist() == ["machine1", "machine2"]
+    with freeze_time("2026-02-28T03:00:00Z"):
+        assert export.export(str(tmp_path)) == 1, "only the last partition"
@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+
+import peewee
+
+from ..model import SCHEMA_VERSION, VM, db_setup
+
+# the schema before the versioning has been introduced
+UNVERSIONED_SCHEMA = (
+    'CREATE TABLE "vm" ("local_id" TEXT NOT NULL PRIMARY KEY, "namespace" VARCHAR(255) NOT NULL,'
+    ' "machine" VARCHAR(255) NOT NULL, "local_user_id" VARCHAR(255), "local_group_id" VARCHAR(255),'
+    ' "global_user_name" VARCHAR(255), "fqan" VARCHAR(255), "status" VARCHAR(255),'
+    ' "start_time" DATETIME, "end_time" DATETIME, "suspend_duration" REAL, "wall" REAL,'
+    ' "cpu_duration" REAL, "cpu_count" REAL, "network_type" VARCHAR(255), "network_inbound" REAL,'
+    ' "network_outbound" REAL, "memory" REAL, "disk" REAL, "storage_record" VARCHAR(255),'
+    ' "image_id" VARCHAR(255), "benchmark_type" VARCHAR(255), "benchmark" VARCHAR(255),'
+    ' "public_ip_count" INTEGER, "flavor" VARCHAR(255))'
+)
+
+
+def old_pod(database, i: int, start_time: str | None, end_time: str | None) -> None:
+    """Insert pod with text timestamps."""
+    database.execute_sql(
+        'INSERT INTO "vm" ("local_id", "namespace", "machine", "start_time", "end_time")'
+        " VALUES (?, ?, ?, ?, ?)",
+        (
+            f"00000000-0000-0000-0000-00000000000{i}",
+            "ns",
+            f"m{i}",
+            start_time,
+            end_time,
+        ),
+    )
+
+
+def test_migrate_epoch(tmp_path) -> None:
+    """Text timestamps of the unversioned database are converted in place."""
+    database = peewee.SqliteDatabase(str(tmp_path / "old.db"))
+    database.execute_sql(UNVERSIONED_SCHEMA)
+    old_pod(database, 1, "2026-02-27 13:00:00+00:00", "2026-02-27 14:00:00.5")
+    old_pod(database, 2, "2026-02-27 13:00:00", None)
+    assert database.user_version == 0
+
+    db_setup(database)
+
+    assert database.user_version == SCHEMA_VERSION, "schema upgraded"
+    rows = database.execute_sql(
+        'SELECT "start_time", "end_time" FROM "vm" ORDER BY "machine"'
+    ).fetchall()
+    assert rows == [(1772197200, 1772200800), (1772197200, None)]
+    with database.bind_ctx([VM]):
+        pod = VM.get(VM.machine == "m1")
+        assert pod.start_time == datetime(2026, 2, 27, 13, tzinfo=timezone.utc)
+        assert VM.select().where(VM.end_time.is_null()).count() == 1
+
+
+def test_naive_datetime() -> None:
+    """Naive datetimes are stored as UTC."""
+    field = VM.start_time
+    naive = datetime(2026, 2, 27, 10, 0, 0)
+    assert field.db_value(naive) == field.db_value(naive.replace(tzinfo=timezone.utc))
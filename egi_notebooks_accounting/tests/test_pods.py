@@ -0,0 +1,316 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from dirq import QueueSimple
+from freezegun import freeze_time
+
+from .. import pods
+from ..model import VM
+from ..pods import FqanMapping, get_last_running, update_status
+from .conftest import FakePrometheus, TestHelpers
+
+# 2026-02-27T00:00:00Z
+START = 1772150400
+
+
+def phase_values(phases: str, start: int = START, step: int = 30) -> list:
+    """Matrix values of kube_pod_status_phase from string like "0011100"."""
+    return [[start + i * step + 0.123, phase] for i, phase in enumerate(phases)]
+
+
+def new_pod() -> VM:
+    return VM(start_time=datetime.fromtimestamp(START, timezone.utc))
+
+
+def test_last_running() -> None:
+    """Last running timestamp is the same as from the full scan."""
+    for phases in ["", "0", "000", "1", "0110", "01101000", "1111"]:
+        values = phase_values(phases)
+        running = [v[0] for v in values if v[1] == "1"]
+        expected = int(running[-1]) if running else None
+        assert get_last_running(values) == expected, f"phases {phases}"
+
+
+def test_status_completed() -> None:
+    pod = new_pod()
+    update_status(pod, START + 600, START + 3600)
+    assert pod.status == "completed"
+    assert pod.end_time.timestamp() == START + 600
+    assert pod.wall == 600
+
+
+def test_status_started() -> None:
+    pod = new_pod()
+    update_status(pod, START + 3570, START + 3600)
+    assert pod.status == "started"
+    assert pod.end_time is None
+    assert pod.wall == 3570
+
+
+def test_status_never_running() -> None:
+    pod = new_pod()
+    update_status(pod, None, START + 60)
+    assert pod.status == "started", "recent launch"
+    assert pod.wall == 0
+
+    pod = new_pod()
+    update_status(pod, None, START + 3600)
+    assert pod.status == "completed", "ended too fast"
+    assert pod.end_time == pod.start_time
+    assert pod.wall == 0
+
+
+def launch_pods(
+    pytestconfig, monkeypatch, spool_dir, now: int, config_file: str | None = None
+) -> list[str]:
+    """
+    Launch pods.py harvester at the given time.
+
+    Returns list of the new messages in the spool dir.
+    """
+    monkeypatch.setenv("APEL_SPOOL", str(spool_dir))
+    # ticking clock: spool element names are derived from the time
+    with freeze_time(datetime.fromtimestamp(now, timezone.utc), tick=True):
+        pods.main(["-c", config_file or str(pytestconfig.config_file)])
+    queue = QueueSimple.QueueSimple(str(spool_dir))
+    messages = []
+    for name in queue:
+        if queue.lock(name):
+            messages.append(queue.get(name).decode())
+            queue.remove(name)
+    return messages
+
+
+@pytest.mark.parametrize("status_query", ["range", "reduced", "remote_read"])
+def test_harvest(
+    pytestconfig, requests_mock, monkeypatch, tmp_path, status_query
+) -> None:
+    """Completed and running pods are harvested."""
+    monkeypatch.setenv("STATUS_QUERY", status_query)
+    prom = FakePrometheus(requests_mock)
+    uid1 = prom.pod(1, START, "0" + "1" * 20 + "0", cpu=30)
+    uid2 = prom.pod(2, START, "1" * 121)
+    uid3 = prom.pod(3, START, "0" * 10)
+
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+
+    assert len(messages) == 1, "one APEL message"
+    assert messages[0].count("VMUUID:") == 3, "three records"
+    metadata_queries = [q for q in prom.queries if "kube_pod_created" in q]
+    assert len(metadata_queries) == 1, "pod metadata in one query"
+    assert "kube_pod_annotations" in metadata_queries[0]
+    assert "kube_pod_container_info" in metadata_queries[0]
+    assert not [q for q in prom.queries if ":1h]" in q], "no series by default"
+    if status_query == "remote_read":
+        assert len(prom.reads) == 1, "status samples by remote read"
+        assert not [q for q in prom.queries if "kube_pod_status_phase" in q]
+    pod1 = VM.get_by_id(uid1)
+    assert pod1.status == "completed"
+    assert pod1.end_time.timestamp() == START + 600
+    assert pod1.wall == 600
+    assert pod1.cpu_duration == 30
+    assert pod1.flavor == TestHelpers.flavor_name
+    assert pod1.fqan == TestHelpers.FQAN
+    assert pod1.image_id == FakePrometheus.IMAGE
+    pod2 = VM.get_by_id(uid2)
+    assert pod2.status == "started"
+    assert pod2.end_time is None
+    assert pod2.wall == 3600
+    pod3 = VM.get_by_id(uid3)
+    assert pod3.status == "completed", "never running"
+    assert pod3.end_time == pod3.start_time
+    assert pod3.wall == 0
+
+
+@pytest.mark.parametrize(
+    "shard_by,shards,queries", [("pod", 4, 4), ("namespace", 1, 1)]
+)
+def test_sharded(
+    pytestconfig, requests_mock, monkeypatch, tmp_path, shard_by, shards, queries
+) -> None:
+    """Shards are harvested and flushed one after another."""
+    monkeypatch.setenv("SHARD_BY", shard_by)
+    monkeypatch.setenv("SHARDS", str(shards))
+    prom = FakePrometheus(requests_mock)
+    uids = [prom.pod(i, START, "1" * 121) for i in range(1, 4)]
+
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+
+    metadata_queries = [q for q in prom.queries if "kube_pod_created" in q]
+    assert len(metadata_queries) == queries + (shard_by == "namespace")
+    # pods ending by 1, 2, 3 are in different shards of 4
+    assert len(messages) == (3 if shard_by == "pod" else 1), "message per shard"
+    assert sum(message.count("VMUUID:") for message in messages) == 3
+    assert VM.select().count() == 3
+    for uid in uids:
+        assert VM.get_by_id(uid).status == "started"
+
+
+def open_record(i: int, start: int, machine: str, namespace: str = "testsuite"):
+    pod = TestHelpers.pod(i, datetime.fromtimestamp(start, timezone.utc), None)
+    pod.machine, pod.namespace, pod.wall = machine, namespace, 3600
+    pod.cpu_count = 1
+    pod.save()
+    return str(pod.local_id)
+
+
+@pytest.mark.parametrize("shard_by,shards", [("pod", 1), ("pod", 4), ("namespace", 1)])
+def test_reconcile(
+    pytestconfig, requests_mock, monkeypatch, tmp_path, shard_by, shards
+) -> None:
+    """Open records of the pods not seen anymore are closed."""
+    monkeypatch.setenv("SHARD_BY", shard_by)
+    monkeypatch.setenv("SHARDS", str(shards))
+    prom = FakePrometheus(requests_mock)
+    stale = open_record(100, START - 3 * 86400, "jupyter-stale")
+    orphan = open_record(101, START - 3 * 86400, "jupyter-orphan", "empty")
+    recent = open_record(102, START + 600, "jupyter-recent")
+    other = open_record(103, START - 3 * 86400, "other-stale")
+
+    launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert VM.get_by_id(stale).end_time is None, "nothing harvested"
+
+    prom.pod(1, START, "1" * 121)
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    for uid in stale, orphan:
+        pod = VM.get_by_id(uid)
+        assert pod.status == "completed"
+        assert pod.end_time.timestamp() == START - 3 * 86400 + 3600
+        assert pod.modified is not None
+        assert any(f"VMUUID: {uid}" in message for message in messages)
+    assert VM.get_by_id(recent).end_time is None, "seen in the range"
+    assert VM.get_by_id(other).end_time is None, "not matching the filter"
+
+
+def test_unchanged(pytestconfig, requests_mock, monkeypatch, tmp_path) -> None:
+    """Unchanged completed pods are not sent again."""
+    prom = FakePrometheus(requests_mock)
+    uid1 = prom.pod(1, START, "0" + "1" * 20 + "0", cpu=30)
+    uid2 = prom.pod(2, START, "1" * 121)
+
+    launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert len(messages) == 1
+    assert f"VMUUID: {uid1}" not in messages[0], "unchanged completed pod skipped"
+    assert f"VMUUID: {uid2}" in messages[0], "running pod sent"
+
+    modified = VM.get_by_id(uid1).modified
+    assert modified is not None, "new pod marked as modified"
+    prom.pods[0]["cpu"] = 40
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert f"VMUUID: {uid1}" in messages[0], "changed completed pod sent"
+    assert VM.get_by_id(uid1).cpu_duration == 40
+    assert VM.get_by_id(uid1).modified == modified, "not a reported field"
+
+    launch_pods(pytestconfig, monkeypatch, tmp_path, START + 7200)
+    pod = VM.get_by_id(uid2)
+    assert pod.end_time is not None
+    assert pod.modified > modified, "ended pod marked as modified"
+
+
+def test_spool_refused(pytestconfig, requests_mock, monkeypatch, tmp_path) -> None:
+    """Completed pods refused by the full spool are queued by the next run."""
+    monkeypatch.setenv("APEL_SPOOL_POLICY", "refuse")
+    monkeypatch.setenv("APEL_SPOOL_MAX_MESSAGES", "1")
+    prom = FakePrometheus(requests_mock)
+    uid1 = prom.pod(1, START, "0" + "1" * 20 + "0", cpu=30)
+    uid2 = prom.pod(2, START, "1" * 121)
+    # not yet sent message
+    QueueSimple.QueueSimple(str(tmp_path)).add("APEL-cloud-message: v0.4\n")
+
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert len(messages) == 1, "only the queued message"
+    assert VM.get_or_none(VM.local_id == uid1) is None, "refused completed pod"
+    assert VM.get_by_id(uid2).status == "started"
+
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert len(messages) == 1
+    assert f"VMUUID: {uid1}" in messages[0], "queued again"
+    assert VM.get_by_id(uid1).status == "completed"
+
+
+def test_metadata_cache(pytestconfig, requests_mock, monkeypatch, tmp_path) -> None:
+    """Annotations and image are queried only for the new pods."""
+    monkeypatch.setenv("METADATA_CACHE", "1")
+    prom = FakePrometheus(requests_mock)
+    uid1 = prom.pod(1, START, "1" * 121)
+
+    launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    uid2 = prom.pod(2, START + 1800, "1" * 61)
+    prom.pods[0]["flavor"] = "changed"
+    prom.queries = []
+    messages = launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+
+    assert messages[0].count("VMUUID:") == 2
+    queries = [q for q in prom.queries if "kube_pod_annotations" in q]
+    assert len(queries) == 1 and uid2 in queries[0] and uid1 not in queries[0]
+    for uid in uid1, uid2:
+        pod = VM.get_by_id(uid)
+        assert pod.global_user_name == TestHelpers.USER
+        assert pod.fqan == TestHelpers.FQAN
+        assert pod.image_id == FakePrometheus.IMAGE
+    assert VM.get_by_id(uid1).flavor == TestHelpers.flavor_name, "cached"
+
+    prom.queries = []
+    launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+    assert not [q for q in prom.queries if "kube_pod_annotations" in q]
+
+
+def test_fqan_mapping() -> None:
+    """Exact values are preferred, then the first matching pattern."""
+    group = "urn:mace:egi.eu:group:%s:role=member#aai.egi.eu"
+    fqans = FqanMapping({group % "vo.example.org": "exact"})
+    fqans.add(group % "vo.*", "glob")
+    fqans.add("re:urn:mace:egi\\.eu:group:([^:]+):.*", "regex")
+    assert fqans.get(group % "vo.example.org") == "exact"
+    assert fqans.get(group % "vo.other.org") == "glob"
+    assert fqans.get(group % "other") == "regex"
+    assert fqans.get(group % "vo.other.org") == "glob", "memoized"
+    assert fqans.get("other") is None
+
+    # flags and group references of the patterns are independent
+    fqans.add("re:(?i)URN:MACE:EGI.EU:GROUP:VO3:.*", "flags")
+    fqans.add("re:(ab)\\1", "backreference")
+    assert fqans.get(group % "vo3") == "regex", "first matching pattern"
+    assert fqans.get("abab") == "backreference"
+    fqans = FqanMapping({"re:(?i)URN:.*": "flags"})
+    assert fqans.get(group % "vo3") == "flags"
+
+
+@pytest.mark.parametrize("value", [TestHelpers.FQAN, "tsu*", "re:ts.*e"])
+def test_vo_mapping(pytestconfig, requests_mock, monkeypatch, tmp_path, value) -> None:
+    """Primary group values are mapped to VO by the [VO] section."""
+    config_file = tmp_path / "config.ini"
+    config = Path(pytestconfig.config_file).read_text()
+    config = config.replace(
+        "[VO]\n",
+        "[VO]\nvo.example.org=other,%s\nvo.other.org=other2,*\n" % value,
+    )
+    config_file.write_text(config)
+    prom = FakePrometheus(requests_mock)
+    uid = prom.pod(1, START, "1" * 121)
+
+    launch_pods(
+        pytestconfig, monkeypatch, tmp_path / "spool", START + 3600, str(config_file)
+    )
+    assert VM.get_by_id(uid).fqan == "vo.example.org"
+
+
+def test_reduced_status(pytestconfig, requests_mock, monkeypatch, tmp_path) -> None:
+    """Reduced status query gives the same end time and wall as the range query."""
+    prom = FakePrometheus(requests_mock)
+    # scrapes not aligned with the subquery steps
+    uids = [
+        prom.pod(1, START, "0" + "1" * 20 + "0" * 10, offset=7),
+        prom.pod(2, START, "1" * 119, offset=7),
+    ]
+    results = {}
+    for status_query in ["range", "reduced"]:
+        monkeypatch.setenv("STATUS_QUERY", status_query)
+        launch_pods(pytestconfig, monkeypatch, tmp_path, START + 3600)
+        pods = [VM.get_by_id(uid) for uid in uids]
+        results[status_query] = [(p.status, p.end_time, p.wall) for p in pods]
+        VM.delete().execute()
+    assert results["range"][0][1].timestamp() == START + 607
+    assert results["reduced"] == results["range"]
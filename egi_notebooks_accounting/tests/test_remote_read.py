@@ -0,0 +1,113 @@
+import math
+import struct
+from array import array
+
+import pytest
+
+from ..remote_read import (
+    RemoteReadError,
+    SeriesSet,
+    decode_xor_chunk,
+    encode_field,
+    encode_read_request,
+    encode_varint,
+    iter_frames,
+    last_time_with_value,
+    parse_matchers,
+    snappy_compress,
+    snappy_decompress,
+)
+from .remote_read_server import (
+    decode_read_request,
+    encode_frame,
+    encode_label,
+    encode_xor_chunk,
+)
+
+# 2026-02-27T00:00:00Z
+START_MS = 1772150400000
+
+
+def test_xor_chunk() -> None:
+    """Irregular scrapes and values survive the XOR encoding."""
+    deltas = [30000, 30000, 30001, 29000, 1, 10**7, 30000, 10**12, 0]
+    values = [0.0, 1.0, 1.0, 0.5, 1e6 / 3, -2.0, math.inf, 1.0, 1.0, 0.0]
+    samples = [(START_MS, values[0])]
+    for delta, value in zip(deltas, values[1:]):
+        samples.append((samples[-1][0] + delta, value))
+    timestamps, decoded = array("q"), array("d")
+    decode_xor_chunk(encode_xor_chunk(samples), timestamps, decoded)
+    assert list(timestamps) == [t for t, _ in samples]
+    assert list(decoded) == [v for _, v in samples]
+
+
+def test_xor_chunk_runs() -> None:
+    """Runs of regular scrapes with the same value mixed with changes."""
+    samples = [(START_MS, 1.0)]
+    for i in range(1, 120):
+        delta = 0 if 50 <= i < 60 else 30000 + (i == 70)
+        samples.append((samples[-1][0] + delta, float(i // 40 % 2)))
+    chunk = encode_xor_chunk(samples)
+    timestamps, decoded = array("q"), array("d")
+    decode_xor_chunk(chunk, timestamps, decoded)
+    assert list(timestamps) == [t for t, _ in samples]
+    assert list(decoded) == [v for _, v in samples]
+    with pytest.raises(RemoteReadError):
+        decode_xor_chunk(chunk[:-4], array("q"), array("d"))
+
+
+def test_snappy() -> None:
+    data = bytes(range(256)) * 300
+    assert snappy_decompress(snappy_compress(data)) == data
+    # compressed by copies: "abcabcabcd"
+    compressed = bytes([10, 2 << 2]) + b"abc" + bytes([2 << 2 | 1, 3, 0]) + b"d"
+    assert snappy_decompress(compressed) == b"abcabcabcd"
+
+
+def test_read_request() -> None:
+    matchers = parse_matchers("pod=~'jupyter-.*', namespace!=\"kube-system\"")
+    assert matchers == [("pod", "=~", "jupyter-.*"), ("namespace", "!=", "kube-system")]
+    queries, accepted = decode_read_request(
+        encode_read_request(matchers, START_MS, START_MS + 3600000)
+    )
+    assert queries == [(matchers, START_MS, START_MS + 3600000)]
+    assert accepted == [1, 0], "streamed chunks preferred"
+
+
+def test_samples_response() -> None:
+    """Not streamed response (older Prometheus) with samples."""
+    labels = encode_field(1, encode_label("uid", "1"))
+    samples = b"".join(
+        # value is double (fixed 64-bit wire type)
+        encode_field(
+            2, encode_varint(1 << 3 | 1) + struct.pack("<d", v) + encode_field(2, t)
+        )
+        for t, v in [(START_MS, 1.0), (START_MS + 30000, 0.0)]
+    )
+    message = encode_field(1, encode_field(1, labels + samples))
+    series = SeriesSet()
+    series.add_samples(message)
+    [(metric, timestamps, values)] = list(series.items())
+    assert metric == {"uid": "1"}
+    assert list(values) == [1.0, 0.0]
+    assert last_time_with_value(timestamps, values) == START_MS // 1000
+
+
+def test_chunked_response() -> None:
+    """Chunks are merged by labels, the last running time needs a chunk with 1."""
+    chunks = []
+    for i in range(4):
+        samples = [(START_MS + (10 * i + k) * 30000, float(i < 2)) for k in range(10)]
+        chunks.append((samples[0][0], samples[-1][0], encode_xor_chunk(samples)))
+    labels = {"uid": "1", "phase": "Running"}
+    frames = [
+        encode_frame([(labels, chunks[:2])]),
+        encode_frame([(labels, chunks[2:])]),
+    ]
+    series = SeriesSet()
+    for message in iter_frames(frames):
+        series.add_chunked(message)
+    assert list(series.last_times()) == [(labels, START_MS // 1000 + 19 * 30)]
+    [(metric, timestamps, values)] = list(series.items())
+    assert len(timestamps) == 40
+    assert list(values) == [1.0] * 20 + [0.0] * 20
@@ -0,0 +1,104 @@
+import csv
+import json
+import logging
+
+import dateutil.parser
+
+from .. import report
+from .conftest import TestHelpers
+
+
+def launch_report(pytestconfig, tmp_path, args: list[str]) -> str:
+    """
+    Launch report.py utility and return its output.
+
+    :param pytestconfig:
+        Pytest fixture, configuration object.
+
+    :param tmp_path:
+        Pytest fixture, temporary directory.
+
+    :param args:
+        Additional command line arguments.
+    """
+    output = tmp_path / "report.out"
+    args = ["-c", str(pytestconfig.config_file), "-o", str(output)] + args
+    logging.info(f"Command: python -m egi_notebooks_accounting.report {' '.join(args)}")
+    assert report.main(args) == 0, "report finished successfully"
+    return output.read_text()
+
+
+def test_day_buckets(pytestconfig, tmp_path) -> None:
+    """Pod across midnight is split into two daily buckets."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-27T23:00:00Z"), 2 * 3600)
+    TestHelpers.pod(2, dateutil.parser.parse("2026-02-28T10:00:00Z"), 3600)
+    # outside of the window
+    TestHelpers.pod(3, dateutil.parser.parse("2026-03-05T10:00:00Z"), 3600)
+
+    rows = list(
+        csv.DictReader(
+            launch_report(
+                pytestconfig,
+                tmp_path,
+                ["--from-date", "2026-02-27", "--to-date", "2026-03-01"],
+            ).splitlines()
+        )
+    )
+    assert len(rows) == 2, "two daily buckets"
+    assert rows[0]["period_start"] == "2026-02-27T00:00:00Z"
+    assert rows[0]["user"] == TestHelpers.USER
+    assert rows[0]["fqan"] == TestHelpers.FQAN
+    assert rows[0]["flavor"] == TestHelpers.flavor_name
+    assert rows[0]["pods"] == "1"
+    assert float(rows[0]["hours"]) == 1.0
+    assert rows[1]["period_start"] == "2026-02-28T00:00:00Z"
+    assert rows[1]["pods"] == "2"
+    assert float(rows[1]["hours"]) == 2.0
+
+
+def test_total_running(pytestconfig, tmp_path) -> None:
+    """Still running pod is clamped to the end of the window."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-01T00:00:00Z"), None)
+    TestHelpers.pod(2, dateutil.parser.parse("2026-02-27T12:00:00Z"), 3600)
+
+    rows = json.loads(
+        launch_report(
+            pytestconfig,
+            tmp_path,
+            [
+                "--from-date",
+                "2026-02-27",
+                "--to-date",
+                "2026-03-01",
+                "--bucket",
+                "total",
+                "--group-by",
+                "namespace",
+                "--format",
+                "json",
+            ],
+        )
+    )
+    assert rows == [
+        {
+            "period_start": "2026-02-27T00:00:00Z",
+            "period_end": "2026-03-01T00:00:00Z",
+            "namespace": "testsuite",
+            "pods": 2,
+            "hours": 49.0,
+        }
+    ]
+
+
+def test_month_buckets() -> None:
+    """Month buckets starting at the end of a month are clamped."""
+    edges = report.get_bucket_edges(
+        report.parse_date("2024-01-31"), report.parse_date("2024-05-01"), "month"
+    )
+    assert [edge.date().isoformat() for edge in edges] == [
+        "2024-01-31",
+        "2024-02-29",
+        "2024-03-31",
+        "2024-04-30",
+        "2024-05-01",
+    ]
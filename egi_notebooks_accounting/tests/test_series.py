@@ -0,0 +1,62 @@
+import csv
+import uuid
+
+import dateutil.parser
+
+from .. import report
+from ..model import VMSeries
+from ..series import get_samples, save_series
+from .conftest import TestHelpers
+
+# 2026-02-27T00:00:00Z
+DAY = 1772150400
+HOUR = 3600
+
+
+def values(start: int, samples: list[float]) -> list:
+    """Prometheus matrix values, evaluated at the end of each hour."""
+    return [[start + (i + 1) * HOUR, str(v)] for i, v in enumerate(samples)]
+
+
+def test_samples() -> None:
+    """Missing samples are zero."""
+    start, samples = get_samples(
+        [[DAY + HOUR, "1"], [DAY + 2 * HOUR, "2"], [DAY + 4 * HOUR, "4"]]
+    )
+    assert start == DAY
+    assert list(samples) == [1.0, 2.0, 0.0, 4.0]
+
+
+def test_merge() -> None:
+    """Overlapping harvests are merged, newer values win."""
+    uid = str(uuid.UUID(int=1))
+    save_series({uid: {"cpu": get_samples(values(DAY, [1, 1, 1]))}})
+    save_series(
+        {
+            uid: {
+                "cpu": get_samples(values(DAY + 2 * HOUR, [2, 2])),
+                "memory": get_samples(values(DAY + 2 * HOUR, [1024, 2048])),
+            }
+        }
+    )
+    row = VMSeries.get_by_id(uid)
+    assert row.start_time.timestamp() == DAY
+    assert row.end_time.timestamp() == DAY + 4 * HOUR
+    assert list(row.get_array("cpu")) == [1.0, 1.0, 2.0, 2.0]
+    assert list(row.get_array("memory")) == [0.0, 0.0, 1024.0, 2048.0]
+    assert list(row.get_array("network_inbound")) == [0.0] * 4
+
+
+def test_report_cpu(pytestconfig, tmp_path) -> None:
+    """CPU hours per day from the hourly series."""
+    pod = TestHelpers.pod(1, dateutil.parser.parse("2026-02-27T22:00:00Z"), 4 * 3600)
+    uid = str(pod.local_id)
+    save_series({uid: {"cpu": get_samples(values(DAY + 22 * HOUR, [1800] * 4))}})
+
+    output = tmp_path / "report.csv"
+    args = ["-c", str(pytestconfig.config_file), "-o", str(output), "--cpu"]
+    args += ["--from-date", "2026-02-27", "--to-date", "2026-03-01"]
+    assert report.main(args) == 0
+    rows = list(csv.DictReader(output.read_text().splitlines()))
+    assert [float(row["hours"]) for row in rows] == [2.0, 2.0]
+    assert [float(row["cpu_hours"]) for row in rows] == [1.0, 1.0]
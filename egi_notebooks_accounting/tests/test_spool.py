@@ -0,0 +1,66 @@
+from ..spool import (
+    POLICY_DROP,
+    POLICY_MERGE,
+    POLICY_REFUSE,
+    Spool,
+    parse_message,
+    parse_size,
+)
+
+
+def record(uid: str, wall: int) -> str:
+    return f"VMUUID: {uid}\nWallDuration: {wall}"
+
+
+def queued(spool: Spool) -> list[dict]:
+    """Records of the queued messages."""
+    messages = []
+    for name in spool.queue:
+        assert spool.queue.lock(name)
+        messages.append(parse_message(spool.queue.get(name).decode()))
+        spool.queue.unlock(name)
+    return sorted(messages, key=lambda records: sorted(records))
+
+
+def test_parse_size() -> None:
+    assert parse_size("0") == 0
+    assert parse_size("1500") == 1500
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5MB") == 1536 * 1024
+
+
+def test_unlimited(tmp_path) -> None:
+    spool = Spool(str(tmp_path / "spool"), metrics_file=str(tmp_path / "spool.prom"))
+    assert spool.add({"a": record("a", 1)})
+    assert spool.add({"a": record("a", 2)})
+    assert spool.stats()[0] == 2
+    metrics = (tmp_path / "spool.prom").read_text()
+    assert "egi_notebooks_accounting_spool_messages 2\n" in metrics
+
+
+def test_merge(tmp_path) -> None:
+    spool = Spool(str(tmp_path), max_messages=2, policy=POLICY_MERGE)
+    assert spool.add({"a": record("a", 1), "b": record("b", 1)})
+    assert spool.add({"a": record("a", 2)})
+    assert spool.add({"a": record("a", 3), "c": record("c", 3)})
+    assert queued(spool) == [
+        {"a": record("a", 3), "b": record("b", 1), "c": record("c", 3)}
+    ]
+
+
+def test_drop(tmp_path) -> None:
+    spool = Spool(str(tmp_path), max_messages=2, policy=POLICY_DROP)
+    assert spool.add({"a": record("a", 1), "b": record("b", 1)})
+    assert spool.add({"a": record("a", 2)})
+    assert spool.add({"a": record("a", 3)})
+    assert queued(spool) == [{"a": record("a", 3)}, {"b": record("b", 1)}]
+    # nothing superseded
+    assert not spool.add({"c": record("c", 3)})
+    assert spool.refused == 1
+
+
+def test_refuse(tmp_path) -> None:
+    spool = Spool(str(tmp_path), max_size=100, policy=POLICY_REFUSE)
+    assert spool.add({"a": record("a", 1)})
+    assert not spool.add({"b": record("b", 1) + "x" * 100})
+    assert spool.stats()[0] == 1
@@ -0,0 +1,81 @@
+import threading
+
+import dateutil.parser
+import pytest
+import requests
+
+from .. import usage
+from ..usage import UsageServer
+from .conftest import TestHelpers
+
+WINDOW = {"from": "2026-02-27", "to": "2026-03-01"}
+
+
+@pytest.fixture(scope="function")
+def usage_url(db):
+    """Usage server on a random port."""
+    server = UsageServer(("127.0.0.1", 0), db, 300)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/usage"
+    server.shutdown()
+    server.server_close()
+
+
+def test_usage(usage_url) -> None:
+    """Usage per user, pods are clamped to the window."""
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-28T23:00:00Z"), 2 * 3600)
+    pod = TestHelpers.pod(2, dateutil.parser.parse("2026-02-28T10:00:00Z"), 3600)
+    pod.global_user_name = "other"
+    pod.save()
+
+    response = requests.get(usage_url, params=WINDOW)
+    assert response.status_code == 200
+    rows = response.json()
+    assert [row["user"] for row in rows] == [TestHelpers.USER, "other"]
+    assert rows[0]["period_start"] == "2026-02-27T00:00:00Z"
+    assert rows[0]["period_end"] == "2026-03-01T00:00:00Z"
+    assert rows[0]["hours"] == 1.0, "clamped to the window"
+
+    rows = requests.get(
+        usage_url, params=dict(WINDOW, group_by="user,flavor", user="other")
+    ).json()
+    assert len(rows) == 1
+    assert rows[0]["flavor"] == TestHelpers.flavor_name
+    assert rows[0]["hours"] == 1.0
+
+
+def test_cache(usage_url, monkeypatch) -> None:
+    """Aggregates are cached until the database is modified."""
+    calls = []
+    get_usage = usage.get_usage
+    monkeypatch.setattr(
+        usage, "get_usage", lambda *args: calls.append(args) or get_usage(*args)
+    )
+    TestHelpers.pod(1, dateutil.parser.parse("2026-02-28T10:00:00Z"), 3600)
+
+    assert len(requests.get(usage_url, params=WINDOW).json()) == 1
+    assert len(requests.get(usage_url, params=WINDOW).json()) == 1
+    assert len(calls) == 1, "cached"
+
+    pod = TestHelpers.pod(2, dateutil.parser.parse("2026-02-28T12:00:00Z"), 3600)
+    pod.global_user_name = "other"
+    pod.save()
+    assert len(requests.get(usage_url, params=WINDOW).json()) == 2
+    assert len(calls) == 2, "invalidated by the change"
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"group_by": "unknown"},
+        {"bucket": "year"},
+        {"from": "2026-03-01", "to": "2026-02-01"},
+        {"from": "invalid"},
+        {"fqan": "vo", "group_by": "user"},
+    ],
+)
+def test_bad_request(usage_url, params) -> None:
+    response = requests.get(usage_url, params=params)
+    assert response.status_code == 400
+    assert "error" in response.json()
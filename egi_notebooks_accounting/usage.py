@@ -0,0 +1,230 @@
+"""Read-only HTTP service with the usage from the notebooks accounting db
+
+Serves the running time of the pods per user, fqan, flavor (or namespace and
+image) for the dashboards, aggregated the same way as the usage reports (see
+report.aggregate, the intervals are clamped like in eosc.update_pod_metric).
+
+GET /usage?group_by=user&from=2026-02-01&to=2026-03-01&bucket=total&user=alice
+
+* group_by: comma separated list of the grouping fields (default: user)
+* from, to: reporting window (default: from the beginning of the current
+  month until now)
+* bucket: hour, day, week, month or total (default: total)
+* user, fqan, flavor, namespace, image: only the rows with the given value
+  of the grouping field
+
+Response is JSON list of the rows, the same as the JSON usage report:
+
+period_start, period_end, <grouping fields>, pods, hours
+
+Aggregates are cached in memory, so the dashboard polling does not scan the
+database on every request. Cached aggregates are dropped after the TTL
+(the running pods are still accumulating time) or when the database is
+modified by the other processes (pods.main), detected by
+"PRAGMA data_version".
+
+Configuration:
+[default]
+notebooks_db=<notebooks db file>
+
+[usage]
+# listen address and port
+host=127.0.0.1
+port=8000
+# lifetime of the cached aggregates (in seconds)
+cache_ttl=300
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from configparser import ConfigParser
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .model import db_init
+from .report import (
+    BUCKETS,
+    GROUP_FIELDS,
+    aggregate,
+    get_bucket_edges,
+    get_rows,
+    parse_date,
+    select_pods,
+)
+
+CONFIG = "default"
+USAGE_CONFIG = "usage"
+DEFAULT_CONFIG_FILE = "config.ini"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = "8000"
+DEFAULT_CACHE_TTL = "300"
+DEFAULT_GROUP_BY = "user"
+DEFAULT_BUCKET = "total"
+
+
+class UsageError(Exception):
+    pass
+
+
+class UsageCache:
+    """Cached values invalidated by the TTL and by the database changes.
+
+    The database connection needs to be kept open, the data version is
+    changed only by the commits of the other connections.
+    """
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self.entries = {}
+
+    def data_version(self):
+        return self.db.execute_sql("PRAGMA data_version").fetchone()[0]
+
+    def get(self, key, compute):
+        version = self.data_version()
+        now = time.monotonic()
+        self.entries = {
+            k: entry
+            for k, entry in self.entries.items()
+            if entry[0] == version and now - entry[1] < self.ttl
+        }
+        if key not in self.entries:
+            self.entries[key] = (version, now, compute())
+        return self.entries[key][2]
+
+
+def get_usage(group_by, from_date, to_date, bucket):
+    """Usage rows of the pods in the window."""
+    edges = get_bucket_edges(from_date, to_date, bucket)
+    fields = [GROUP_FIELDS[group] for group in group_by]
+    report = aggregate(select_pods(from_date, to_date, fields), edges, group_by)
+    return get_rows(report, edges, group_by)
+
+
+def parse_query(query):
+    """Parse the usage query parameters.
+
+    Returns tuple (cache key, arguments of get_usage, filters).
+    """
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    group_by = [
+        group.strip()
+        for group in params.get("group_by", DEFAULT_GROUP_BY).split(",")
+        if group.strip()
+    ]
+    for group in group_by:
+        if group not in GROUP_FIELDS:
+            raise UsageError(f"unknown grouping '{group}'")
+    bucket = params.get("bucket", DEFAULT_BUCKET)
+    if bucket not in BUCKETS:
+        raise UsageError(f"unknown bucket '{bucket}'")
+    try:
+        if "to" in params:
+            to_date = parse_date(params["to"])
+        else:
+            # whole seconds, the aggregates are cached anyway
+            to_date = datetime.now(timezone.utc).replace(microsecond=0)
+        if "from" in params:
+            from_date = parse_date(params["from"])
+        else:
+            from_date = to_date.replace(day=1, hour=0, minute=0, second=0)
+    except (ValueError, OverflowError) as e:
+        raise UsageError(f"invalid date: {e}")
+    if from_date >= to_date:
+        raise UsageError("empty window")
+    filters = {group: params[group] for group in GROUP_FIELDS if group in params}
+    for group in filters:
+        if group not in group_by:
+            raise UsageError(f"filter '{group}' not in group_by")
+    # default window is cached by the parameters, not by the current time
+    key = (tuple(group_by), params.get("from"), params.get("to"), bucket)
+    return key, (group_by, from_date, to_date, bucket), filters
+
+
+class UsageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/usage":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            key, args, filters = parse_query(url.query)
+        except UsageError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        rows = self.server.cache.get(key, lambda: get_usage(*args))
+        rows = [
+            row
+            for row in rows
+            if all(row[group] == value for group, value in filters.items())
+        ]
+        self.send_json(200, rows)
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class UsageServer(HTTPServer):
+    """Single threaded server, the cache and the db connection are shared."""
+
+    def __init__(self, address, db, ttl):
+        super().__init__(address, UsageHandler)
+        self.cache = UsageCache(db, ttl)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Notebooks usage HTTP service")
+    parser.add_argument(
+        "-c", "--config", help="config file", default=DEFAULT_CONFIG_FILE
+    )
+    args = parser.parse_args(argv)
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    config = parser[CONFIG] if CONFIG in parser else {}
+    usage_config = parser[USAGE_CONFIG] if USAGE_CONFIG in parser else {}
+
+    verbose = os.environ.get("VERBOSE", config.get("verbose", 0))
+    verbose = logging.DEBUG if verbose == "1" else logging.INFO
+    logging.basicConfig(level=verbose)
+
+    db_file = os.environ.get("NOTEBOOKS_DB", config.get("notebooks_db", None))
+    if not db_file:
+        logging.error("notebooks_db needs to be configured")
+        return 1
+    host = os.environ.get("USAGE_HOST", usage_config.get("host", DEFAULT_HOST))
+    port = os.environ.get("USAGE_PORT", usage_config.get("port", DEFAULT_PORT))
+    ttl = os.environ.get(
+        "USAGE_CACHE_TTL", usage_config.get("cache_ttl", DEFAULT_CACHE_TTL)
+    )
+
+    db = db_init(db_file)
+    db.connect()
+    server = UsageServer((host, int(port)), db, float(ttl))
+    logging.info(f"Serving usage on http://{host}:{server.server_port}/usage")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())